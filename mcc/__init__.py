@@ -4,11 +4,16 @@
 from .logger import logger
 from . import analysis
 from . import clean
+from . import codec
 from . import config
+from . import index
+from . import inputs
 from . import launch
-from . import instances
+from . import profiling
+from . import shards
 from . import statistics
 from . import storage
 from . import templates
+from . import transport
 
 __version__ = "0.1.0"
@@ -5,50 +5,118 @@ import re
 
 import arrow
 
-from .statistics import get_ec2_price, get_ec2_vcpus
+from .index import get_prices, lookup_aggregate, lookup_log, store_aggregate, store_log
+from .profiling import merge_profiles, read_profile
+from .transport import open_file, strip_extension
+
+
+def parse_log(path):
+    """Parses a manager log file into the info of each run it hosted
+
+    Lines about a run start with "Run {run_id}", so the runs of a manager that hosted several are told apart. Runs
+    that launched no instances are left out.
+
+    Returns
+    -------
+    runs : dict
+        Info of each run by run id, with the instances launched of each instance type under "instance_types" and
+        the type most of them were under "instance_type"
+    """
+    runs = {}
+    start = end = None
+    with open_file(path, "r") as f:
+        for line in f:
+            time = line.split(',')[0]
+            if "START" in line:
+                start = arrow.get(time)
+            if "END" in line:
+                end = arrow.get(time)
+
+            match = re.search(r":Run (\w+)[: ]", line)
+            if match is None:
+                continue
+            _data = runs.setdefault(match.group(1), {"stalls": 0, "instance_types": {}})
+
+            if re.search(r":Run \w+ started", line):
+                _data["start"] = arrow.get(time)
+            if re.search(r":Run \w+ (?:finished|failed)", line):
+                _data["end"] = arrow.get(time)
+
+            if "Manager launched" in line or "Manager adopted" in line:
+                reg = r"Manager (?:launched|adopted) (\d+) \'([\w.-]+)\' Instances\."
+                matches = re.findall(reg, line)[0]
+                _data["instance_types"][matches[1]] = _data["instance_types"].get(matches[1], 0) + int(matches[0])
+
+            if "Hyperthreading = True" in line:
+                _data["hyper"] = 1
+            elif "Hyperthreading = False" in line:
+                _data["hyper"] = 2
+
+            if "stalled:" in line:
+                reg = r"stalled:\s(\d+)"
+                stalled = int(re.findall(reg, line)[0])
+                _data["stalls"] += stalled
+
+    for run_id, _data in list(runs.items()):
+        if not any(_data["instance_types"].values()):
+            del runs[run_id]
+            continue
+        _data["instances"] = sum(_data["instance_types"].values())
+        _data["instance_type"] = max(_data["instance_types"], key=_data["instance_types"].get)
+        if "start" not in _data and start is not None:
+            _data["start"] = start
+        if "end" not in _data and end is not None:
+            _data["end"] = end
+
+    return runs
 
 
-def collect_data(files):
-    "Collects relevant data from log files"
+def collect_data(files, index=None):
+    "Collects relevant data of each run from manager log files, only parsing new or changed files if a run index is given"
     data = {}
 
     for file in files:
-        _data = {"stalls": 0}
-        with open(os.path.join("results", file), "r") as f:
-            for line in f.readlines():
-                if "START" in line:
-                    _data["start"] = arrow.get(line.split(',')[0])
-                if "END" in line:
-                    _data["end"] = arrow.get(line.split(',')[0])
-
-                if "Manager launched" in line:
-                    reg = r"MASTER launched (\d+) \'(\w\d\.[\w\d]+)\' Instances\."
-                    matches = re.findall(reg, line)[0]
-                    _data["instances"] = int(matches[0])
-                    _data["instance_type"] = matches[1]
-
-                if "Hyperthreading = True" in line:
-                    _data["hyper"] = 1
-                elif "Hyperthreading = False" in line:
-                    _data["hyper"] = 2
-
-                if "stalled:" in line:
-                    reg = r"stalled:\s(\d+)"
-                    stalled = int(re.findall(reg, line)[0][0])
-                    _data["stalls"] += stalled
-
-        if "instances" not in _data:
-            continue
+        path = os.path.join("results", file)
+
+        if index is not None:
+            stat = os.stat(path)
+            runs = lookup_log(index, file, stat.st_size, stat.st_mtime)
+            if runs is None:
+                runs = parse_log(path)
+                store_log(index, file, stat.st_size, stat.st_mtime, runs)
+        else:
+            runs = parse_log(path)
 
-        data[file.replace("_manager.log", "")] = _data
+        data.update(runs)
 
     return data
 
 
-def aggregate_data(data):
-    "aggregates information from data-collected log files"
-    for instance, info in data.items():
-        info["data_size"] = os.stat(f"results/{instance}.h5").st_size / 1024
+def result_file(run_id, files=None):
+    """Returns the path of the combined result of a run downloaded to results/, `results/{run_id}_{output_file}`,
+    or None if it has not been downloaded"""
+    if files is None:
+        files = os.listdir("results")
+
+    for file in sorted(files):
+        if file.startswith(f"{run_id}_"):
+            return os.path.join("results", file)
+
+    return None
+
+
+def aggregate_data(data, index=None):
+    "aggregates information from data-collected log files, reusing indexed statistics if a run index is given"
+    files = os.listdir("results")
+    for run_id, info in data.items():
+        stat = os.stat(result_file(run_id, files))
+        if index is not None:
+            aggregate = lookup_aggregate(index, run_id, stat.st_size, stat.st_mtime)
+            if aggregate is not None:
+                info.update(aggregate)
+                continue
+
+        info["data_size"] = stat.st_size / 1024
         info["total_time"] = (info["end"] - info["start"]).total_seconds() / 60 / 60
 
         if info["total_time"] < 1:
@@ -56,11 +124,19 @@ def aggregate_data(data):
         else:
             charge_time = info["total_time"]
 
-        info["vcpus"] = (info["instances"] * get_ec2_vcpus(instance_type=info["instance_type"]) + 1)
-        info["total_cost"] = charge_time * (info["instances"] * get_ec2_price(instance_type=info["instance_type"]) + get_ec2_price(instance_type="t2.micro")) + info["stalls"] * get_ec2_price(instance_type=info["instance_type"])
+        instance_types = info.get("instance_types") or {info["instance_type"]: info["instances"]}
+        prices = {instance_type: get_prices(index, instance_type) for instance_type in instance_types}
+        manager_price, _ = get_prices(index, "t2.micro")
+        instances_price = sum(count * prices[instance_type][0] for instance_type, count in instance_types.items())
+
+        info["vcpus"] = sum(count * prices[instance_type][1] for instance_type, count in instance_types.items()) + 1
+        info["total_cost"] = charge_time * (instances_price + manager_price) + info["stalls"] * prices[info["instance_type"]][0]
         info["cost_per_vcpu"] = info["total_cost"] / info["vcpus"]
         info["time_per_vcpu"] = info["total_time"] / info["vcpus"]
 
+        if index is not None:
+            store_aggregate(index, run_id, stat.st_size, stat.st_mtime, info)
+
     return data
 
 
@@ -128,3 +204,49 @@ def output_analysis(analysis, file="analysis.txt", delimiter="\t"):
 
     with open(file, "w") as f:
         f.write(analysis_out)
+
+
+def update_index(index):
+    """Parses and aggregates new or changed manager logs in results/ into the run index
+
+    Parameters
+    ----------
+    index : sqlite3.Connection
+        Run index, see `mcc.index.open_index`
+
+    Returns
+    -------
+    data : dict
+        Info of every run whose combined result is in results/
+    """
+    files = os.listdir("results")
+    data = collect_data([file for file in files if strip_extension(file).endswith("_manager.log")], index=index)
+    data = {run_id: info for run_id, info in data.items() if result_file(run_id, files) is not None}
+    return aggregate_data(data, index=index)
+
+
+def load_profiles(run_ids=None):
+    """Loads and merges the profiles of runs downloaded to results/
+
+    Parameters
+    ----------
+    run_ids : list{string}, optional
+        Runs to merge (Default: every run with a profile in results/)
+
+    Returns
+    -------
+    profile : dict
+        "stacks", a Counter of samples by collapsed stack, "points", the wall time and samples of each profiled
+        point, "phases", the total time of each manager phase of the runs, and "loop", the time of each phase of
+        the loop of each manager. Write it with `mcc.profiling.write_profile` for flamegraph tools
+    """
+    if run_ids is None:
+        run_ids = [file[:-len(".profile.json")] for file in os.listdir("results") if file.endswith(".profile.json")]
+
+    profiles = [read_profile(os.path.join("results", f"{run_id}.profile")) for run_id in run_ids]
+    profile = merge_profiles(profiles)
+    profile["loop"] = {}
+    for run_profile in profiles:
+        profile["loop"].update(run_profile.get("loop", {}))
+
+    return profile
@@ -0,0 +1,22 @@
+#!/opt/anaconda/bin/python
+"""UserData Script that runs a userdata script uploaded to script/ in S3 with its data
+
+EC2 limits UserData to 16KB, which the manager and worker scripts exceed, so only this stub is sent as UserData.
+"""
+import json
+import os
+import sys
+
+import boto3
+
+bootstrap = json.loads({{bootstrap}})
+
+boto3.client("s3").download_file(bootstrap['s3_bucket'], f"script/{bootstrap['script']}", bootstrap['script'])
+
+with open(bootstrap['script'], "r") as f:
+    script = f.read().replace(bootstrap['placeholder'], repr(json.dumps(bootstrap['data'])))
+
+with open(bootstrap['script'], "w") as f:
+    f.write(script)
+
+os.execv(sys.executable, [sys.executable, bootstrap['script']])
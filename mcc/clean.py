@@ -40,3 +40,8 @@ def delete_security_group(security_group_id, ec2=boto3.resource("ec2")):
 
 def delete_cache_cluster(name, cache_client=boto3.client("elasticache")):
     response = cache_client.delete_cache_cluster(CacheClusterId=name)
+
+
+def delete_redis_shards(group_ids, cache_client=boto3.client("elasticache")):
+    for group_id in group_ids:
+        cache_client.delete_replication_group(ReplicationGroupId=group_id, RetainPrimaryCluster=False)
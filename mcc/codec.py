@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Compact binary encoding of points
+
+Points are queued in redis and handed to the entry point in this encoding. An entry point reads its point,
+with the types it was created with, by calling `read_point()` instead of parsing `sys.argv`.
+
+This module has no dependencies on the rest of mcc so that it can be uploaded next to the worker scripts.
+"""
+import json
+import sys
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MSGPACK = b"M"
+JSON = b"J"
+
+NDARRAY = 1
+
+
+def _msgpack_default(obj):
+    "Encodes numpy arrays as an extension type and numpy scalars as python scalars"
+    if np is not None:
+        if isinstance(obj, np.ndarray):
+            return msgpack.ExtType(NDARRAY, msgpack.packb([obj.dtype.str, list(obj.shape), np.ascontiguousarray(obj).tobytes()]))
+        if isinstance(obj, np.generic):
+            return obj.item()
+    raise TypeError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def _msgpack_ext_hook(code, data):
+    "Decodes numpy arrays"
+    if code == NDARRAY and np is not None:
+        dtype, shape, buffer = msgpack.unpackb(data, raw=False)
+        return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+    return msgpack.ExtType(code, data)
+
+
+def _json_default(obj):
+    "Encodes numpy arrays and scalars as python lists and scalars"
+    if np is not None and isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Cannot encode object of type {type(obj).__name__}")
+
+
+def pack_point(point):
+    """Encodes a point
+
+    Parameters
+    ----------
+    point : list, tuple, dict or numpy array
+        Point as returned by `get_points`
+
+    Returns
+    -------
+    data : bytes
+        msgpack encoding of the point, or JSON if msgpack is not installed, prefixed with a format byte
+    """
+    if msgpack is not None:
+        return MSGPACK + msgpack.packb(point, default=_msgpack_default, use_bin_type=True)
+
+    return JSON + json.dumps(point, default=_json_default, separators=(",", ":")).encode()
+
+
+def unpack_point(data):
+    """Decodes a point encoded with `pack_point`
+
+    Parameters
+    ----------
+    data : bytes
+        Encoded point
+
+    Returns
+    -------
+    point : list, dict or numpy array
+        Decoded point. Floats are returned at full precision, and numpy arrays with their original dtype
+    """
+    fmt, data = data[:1], data[1:]
+    if fmt == MSGPACK:
+        if msgpack is None:
+            raise RuntimeError("Point is msgpack encoded, but msgpack is not installed")
+        return msgpack.unpackb(data, ext_hook=_msgpack_ext_hook, raw=False)
+    if fmt == JSON:
+        return json.loads(data)
+
+    raise ValueError(f"Unknown point encoding {fmt!r}")
+
+
+def split_point(point):
+    """Splits a point into its values and its resource hints
+
+    A point is either its values alone, or a dict with the values under "point" and resource hints under
+    "resources", e.g. `{"point": [0.1, 0.2], "resources": {"memory": 4096, "cpus": 2}}`, where memory is
+    in MB.
+
+    Parameters
+    ----------
+    point : list, dict or numpy array
+        Decoded point
+
+    Returns
+    -------
+    values : list, dict or numpy array
+        Values handed to the entry point
+
+    resources : dict
+        Resource hints of the point, empty if none were given
+    """
+    if isinstance(point, dict) and "point" in point:
+        return point["point"], point.get("resources") or {}
+
+    return point, {}
+
+
+def read_point(stream=None):
+    """Reads the point handed to an entry point on its standard input
+
+    Parameters
+    ----------
+    stream : binary file, optional
+        Stream to read the encoded point from (Default: standard input)
+
+    Returns
+    -------
+    point : list, dict or numpy array
+        Decoded point
+    """
+    if stream is None:
+        stream = sys.stdin.buffer
+
+    return unpack_point(stream.read())
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Persistent index of analysed runs
+
+Parsed manager logs, aggregated run statistics and instance pricing are stored in a local SQLite database, so
+that historical runs are only parsed and priced once. Logs and data files are keyed by their size and
+modification time, and are parsed again if either changes. A manager log records every run the manager hosted.
+"""
+import json
+import sqlite3
+
+import arrow
+
+from .statistics import get_ec2_price, get_ec2_vcpus
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (file TEXT PRIMARY KEY, size INTEGER, mtime REAL);
+CREATE TABLE IF NOT EXISTS log_runs (file TEXT, run_id TEXT, PRIMARY KEY (file, run_id));
+CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, start TEXT, end TEXT, instances INTEGER, instance_type TEXT,
+                                 instance_types TEXT, hyper INTEGER, stalls INTEGER, data_size REAL, data_file_size INTEGER,
+                                 data_file_mtime REAL, total_time REAL, vcpus INTEGER, total_cost REAL,
+                                 cost_per_vcpu REAL, time_per_vcpu REAL);
+CREATE INDEX IF NOT EXISTS runs_instance_type ON runs (instance_type);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start);
+CREATE INDEX IF NOT EXISTS runs_data_size ON runs (data_size);
+CREATE TABLE IF NOT EXISTS prices (instance_type TEXT PRIMARY KEY, price REAL, vcpus INTEGER);
+"""
+
+LOG_FIELDS = ["start", "end", "instances", "instance_type", "instance_types", "hyper", "stalls"]
+AGGREGATE_FIELDS = ["data_size", "total_time", "vcpus", "total_cost", "cost_per_vcpu", "time_per_vcpu"]
+
+
+def open_index(path="results/runs.sqlite"):
+    """Opens the run index, creating it if necessary
+
+    Parameters
+    ----------
+    path : string, optional
+        Path of the SQLite database (Default: "results/runs.sqlite")
+
+    Returns
+    -------
+    index : sqlite3.Connection
+        Connection to the index
+    """
+    index = sqlite3.connect(path)
+    index.row_factory = sqlite3.Row
+    index.executescript(SCHEMA)
+    return index
+
+
+def _row_to_info(row):
+    "Converts a row of the runs table to the info dict used by `mcc.analysis`"
+    info = {key: row[key] for key in LOG_FIELDS + AGGREGATE_FIELDS if row[key] is not None}
+    for key in ["start", "end"]:
+        if key in info:
+            info[key] = arrow.get(info[key])
+    if "instance_types" in info:
+        info["instance_types"] = json.loads(info["instance_types"])
+    return info
+
+
+def lookup_log(index, file, size, mtime):
+    """Returns the indexed info of the runs of a manager log if it is unchanged
+
+    Returns
+    -------
+    runs : dict or None
+        Info of each run of the log by run id, None if the log is new or has changed
+    """
+    log = index.execute("SELECT * FROM logs WHERE file = ? AND size = ? AND mtime = ?", (file, size, mtime)).fetchone()
+    if log is None:
+        return None
+
+    rows = index.execute("SELECT runs.* FROM log_runs LEFT JOIN runs USING (run_id) WHERE log_runs.file = ?", (file,)).fetchall()
+    if any(row["run_id"] is None for row in rows):
+        return None
+
+    return {row["run_id"]: _row_to_info(row) for row in rows}
+
+
+def store_log(index, file, size, mtime, runs):
+    "Stores the parsed info of the runs of a manager log"
+    with index:
+        index.execute("INSERT OR REPLACE INTO logs (file, size, mtime) VALUES (?, ?, ?)", (file, size, mtime))
+        index.execute("DELETE FROM log_runs WHERE file = ?", (file,))
+        for run_id, info in runs.items():
+            values = [str(info[key]) if key in ["start", "end"] and key in info else info.get(key) for key in LOG_FIELDS]
+            values[LOG_FIELDS.index("instance_types")] = json.dumps(info.get("instance_types", {}))
+            index.execute("INSERT INTO log_runs VALUES (?, ?)", (file, run_id))
+            index.execute("INSERT OR IGNORE INTO runs (run_id) VALUES (?)", (run_id,))
+            index.execute(f"UPDATE runs SET {', '.join(f'{key} = ?' for key in LOG_FIELDS)}, data_file_size = NULL, "
+                          f"data_file_mtime = NULL WHERE run_id = ?", values + [run_id])
+
+
+def lookup_aggregate(index, run_id, size, mtime):
+    "Returns the indexed aggregate statistics of a run if its data file is unchanged, otherwise None"
+    row = index.execute("SELECT * FROM runs WHERE run_id = ? AND data_file_size = ? AND data_file_mtime = ?",
+                        (run_id, size, mtime)).fetchone()
+    if row is None:
+        return None
+
+    return {key: row[key] for key in AGGREGATE_FIELDS}
+
+
+def store_aggregate(index, run_id, size, mtime, info):
+    "Stores the aggregate statistics of a run, keyed by the size and modification time of its data file"
+    with index:
+        index.execute(f"UPDATE runs SET {', '.join(f'{key} = ?' for key in AGGREGATE_FIELDS)}, data_file_size = ?, data_file_mtime = ? "
+                      f"WHERE run_id = ?", [info[key] for key in AGGREGATE_FIELDS] + [size, mtime, run_id])
+
+
+def get_prices(index, instance_type):
+    """Returns the price in USD/hr and the number of vcpus of an instance type, querying the pricing API only once
+
+    Parameters
+    ----------
+    index : sqlite3.Connection or None
+        Run index. If None, the pricing API is always queried
+
+    instance_type : string
+        EC2 instance type
+
+    Returns
+    -------
+    price : float
+        On demand price in USD/hr
+
+    vcpus : int
+        Number of vcpus
+    """
+    if index is not None:
+        row = index.execute("SELECT price, vcpus FROM prices WHERE instance_type = ?", (instance_type,)).fetchone()
+        if row is not None:
+            return row["price"], row["vcpus"]
+
+    price, vcpus = get_ec2_price(instance_type=instance_type), get_ec2_vcpus(instance_type=instance_type)
+
+    if index is not None:
+        with index:
+            index.execute("INSERT OR REPLACE INTO prices VALUES (?, ?, ?)", (instance_type, price, vcpus))
+
+    return price, vcpus
+
+
+def query_runs(index, instance_type=None, start=None, end=None, min_size=None, max_size=None):
+    """Queries indexed runs without loading the rest of the index
+
+    Parameters
+    ----------
+    index : sqlite3.Connection
+        Run index
+
+    instance_type : string or list{string}, optional
+        Only runs on these worker instance types
+
+    start, end : arrow.Arrow or string, optional
+        Only runs that started in this date range
+
+    min_size, max_size : float, optional
+        Only runs whose data size in KB is in this range
+
+    Returns
+    -------
+    data : dict
+        Info of each matching run by run id, in the format of `mcc.analysis.aggregate_data`
+    """
+    conditions, parameters = [], []
+    if instance_type is not None:
+        instance_types = [instance_type] if isinstance(instance_type, str) else list(instance_type)
+        conditions.append(f"instance_type IN ({', '.join('?' * len(instance_types))})")
+        parameters.extend(instance_types)
+    if start is not None:
+        conditions.append("start >= ?")
+        parameters.append(str(arrow.get(start)))
+    if end is not None:
+        conditions.append("start < ?")
+        parameters.append(str(arrow.get(end)))
+    if min_size is not None:
+        conditions.append("data_size >= ?")
+        parameters.append(min_size)
+    if max_size is not None:
+        conditions.append("data_size <= ?")
+        parameters.append(max_size)
+
+    query = "SELECT * FROM runs"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    return {row["run_id"]: _row_to_info(row) for row in index.execute(query + " ORDER BY start", parameters)}
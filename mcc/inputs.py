@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""Node-local cache of read-only inputs shared by every slot
+
+The inputs declared by a run are downloaded once per node, converted to flat binary files, and memory mapped
+read-only by each entry point, so that all slots on a node share one copy in the page cache instead of each
+parsing its own. Numpy arrays (".npy"), archives of arrays (".npz") and HDF5 files (".h5", ".hdf5") are converted
+to one ".npy" file per array. Any other file is mapped as raw bytes.
+
+An entry point gets zero-copy views of its inputs with `load_input`:
+
+    from inputs import load_input
+
+    table = load_input("pseudopotentials")  # read-only numpy memmap
+
+This module has no dependencies on the rest of mcc so that it can be uploaded next to the worker scripts.
+"""
+import hashlib
+import json
+import mmap
+import os
+import shutil
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MANIFEST = "inputs.json"
+
+_loaded = {}
+
+
+def _cache_name(bucket, key, etag):
+    "Name of the cache directory of an S3 object, which changes whenever the object does"
+    return hashlib.sha256(f"{bucket}/{key}/{etag}".encode()).hexdigest()[:32]
+
+
+def _convert(path, outdir):
+    """Converts a downloaded input into memory mappable files in outdir
+
+    Returns its manifest entry, with the names of the files relative to outdir"""
+    name = os.path.basename(path)
+    if np is not None and name.endswith(".npy"):
+        shutil.move(path, os.path.join(outdir, name))
+        return dict(type="array", file=name)
+
+    if np is not None and name.endswith(".npz"):
+        files = {}
+        with np.load(path) as archive:
+            for array in archive.files:
+                files[array] = f"{array}.npy"
+                np.save(os.path.join(outdir, files[array]), archive[array])
+        os.remove(path)
+        return dict(type="arrays", files=files)
+
+    if np is not None and name.endswith((".h5", ".hdf5")):
+        import h5py
+
+        files = {}
+
+        def save(dataset_name, obj):
+            if isinstance(obj, h5py.Dataset):
+                files[dataset_name] = f"{dataset_name.replace('/', '.')}.npy"
+                np.save(os.path.join(outdir, files[dataset_name]), obj[()])
+
+        with h5py.File(path, "r") as f:
+            f.visititems(save)
+        os.remove(path)
+        return dict(type="arrays", files=files)
+
+    return dict(type="raw", file=name)
+
+
+def prepare_inputs(client, bucket, inputs, cache_dir="cache"):
+    """Downloads and converts the inputs of a run, unless they are already cached on this node
+
+    Inputs are cached by bucket, key and ETag, so runs that share an input share its cache.
+
+    Parameters
+    ----------
+    client : s3 client
+        S3 client object
+
+    bucket : string
+        Name of bucket
+
+    inputs : dict
+        S3 key of each input by name
+
+    cache_dir : string, optional
+        Node-local cache directory (Default: "cache")
+
+    Returns
+    -------
+    manifest : dict
+        Manifest entry of each input by name, with the cache directory of the input under "dir"
+    """
+    manifest = {}
+    for name, key in inputs.items():
+        etag = client.head_object(Bucket=bucket, Key=key)["ETag"].strip('"')
+        outdir = os.path.abspath(os.path.join(cache_dir, _cache_name(bucket, key, etag)))
+        if not os.path.exists(os.path.join(outdir, MANIFEST)):
+            staging = f"{outdir}.{os.getpid()}.tmp"
+            os.makedirs(staging, exist_ok=True)
+            download = os.path.join(staging, os.path.basename(key))
+            client.download_file(bucket, key, download)
+            with open(os.path.join(staging, MANIFEST), "w") as f:
+                json.dump(_convert(download, staging), f)
+            try:
+                os.rename(staging, outdir)
+            except OSError:
+                shutil.rmtree(staging)
+
+        with open(os.path.join(outdir, MANIFEST), "r") as f:
+            manifest[name] = dict(json.load(f), dir=outdir)
+
+    return manifest
+
+
+def write_manifest(manifest, path=MANIFEST):
+    "Writes the manifest of the inputs of a run where its entry point reads it"
+    with open(path, "w") as f:
+        json.dump(manifest, f)
+
+
+def _map(path, entry_type):
+    "Memory maps one file read-only"
+    if entry_type == "raw":
+        with open(path, "rb") as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)) if os.path.getsize(path) else memoryview(b"")
+    return np.load(path, mmap_mode="r")
+
+
+def load_input(name, manifest=None):
+    """Returns a zero-copy, read-only view of an input of the run
+
+    Parameters
+    ----------
+    name : string
+        Name of the input, as declared in `inputs` when the run was launched
+
+    manifest : string, optional
+        Path of the manifest of the inputs (Default: the MCC_INPUTS environment variable, or "inputs.json" in the
+        current directory)
+
+    Returns
+    -------
+    view : numpy.memmap, dict{numpy.memmap} or memoryview
+        Memory mapped array of ".npy" inputs, dict of memory mapped arrays by name of ".npz" and HDF5 inputs, and
+        memoryview of the bytes of any other input
+    """
+    if name not in _loaded:
+        with open(manifest or os.environ.get("MCC_INPUTS", MANIFEST), "r") as f:
+            entry = json.load(f)[name]
+        if entry["type"] == "arrays":
+            _loaded[name] = {array: _map(os.path.join(entry["dir"], file), "array") for array, file in entry["files"].items()}
+        else:
+            _loaded[name] = _map(os.path.join(entry["dir"], entry["file"]), entry["type"])
+
+    return _loaded[name]
@@ -1,59 +1,432 @@
 # -*- coding: utf-8 -*-
 """Instance Management"""
+import asyncio
+import functools
 import json
 import logging
 import os
+import random
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import redis
 
+from .shards import parse_topology
 from .statistics import get_ec2_vcpus
 
+FINISHED_STATES = ["shutting-down", "terminated", "stopping", "stopped"]
 
-def upload_user_entrypoint(s3_bucket_name, location="script", s3=boto3.resource("s3")):
-    """Uploads the user script to script/ on s3 bucket"""
+USERDATA_LIMIT = 16384
+
+
+TEMPLATES = ["bootstrap_userdata.py", "manager_userdata.py", "worker_userdata.py"]
+
+
+def template_path(name, templates=None):
+    "Returns the path of a userdata template, the one shipped with mcc unless `templates` overrides it by name"
+    if templates and name in templates:
+        return templates[name]
+    return os.path.join(os.path.dirname(__file__), name)
+
+
+@functools.lru_cache(maxsize=None)
+def read_template(name):
+    "Reads a userdata template once per process"
+    with open(template_path(name), "r") as f:
+        return f.read()
+
+
+def bootstrap_userdata(s3_bucket, script, placeholder, data):
+    """Renders the UserData stub that downloads a userdata script from script/ in the bucket, replaces its
+    placeholder with the data and runs it
+
+    Raises
+    ------
+    ValueError
+        If the UserData is larger than EC2 accepts
+    """
+    bootstrap = dict(s3_bucket=s3_bucket, script=script, placeholder=placeholder, data=data)
+    userdata = read_template("bootstrap_userdata.py").replace(r"{{bootstrap}}", repr(json.dumps(bootstrap)))
+    if len(userdata.encode()) > USERDATA_LIMIT:
+        raise ValueError(f"UserData of {script} is {len(userdata.encode())} bytes, EC2 accepts at most {USERDATA_LIMIT}")
+
+    return userdata
+
+
+@functools.lru_cache(maxsize=None)
+def cached_vcpus(instance_type):
+    "Returns the number of vcpus of an instance type, querying the pricing API once per process"
+    return get_ec2_vcpus(instance_type=instance_type)
+
+
+@functools.lru_cache(maxsize=None)
+def cached_memory(instance_type):
+    """Returns the memory in MB of an instance type, querying ec2 once per process
+
+    `launch_runs` calls it from several threads, which must not share the default boto3 session."""
+    response = boto3.session.Session().client("ec2").describe_instance_types(InstanceTypes=[instance_type])
+    return response["InstanceTypes"][0]["MemoryInfo"]["SizeInMiB"]
+
+
+def make_worker_pools(worker_pools, template_id, template_version, vcpus_per_node=None, max_workers=None):
+    """Fills in the launch template and capabilities of each worker pool
+
+    Parameters
+    ----------
+    worker_pools : list{dict}
+        Pools with their "instance_type", and optionally "template_id", "template_version", "vcpus_per_node",
+        "memory" in MB and "max_workers". Instance types must be unique
+
+    template_id, template_version : string
+        Launch template of pools without one
+
+    vcpus_per_node, max_workers : int, optional
+        Defaults of pools without them. vcpus are looked up by instance type if not given
+
+    Returns
+    -------
+    worker_pools : list{dict}
+        Pools with every field set, in order of preference
+    """
+    instance_types = [pool["instance_type"] for pool in worker_pools]
+    if len(set(instance_types)) != len(instance_types):
+        raise ValueError(f"Worker pools must have distinct instance types, got {instance_types}")
+
+    pools = []
+    for pool in worker_pools:
+        pool = dict(dict(template_id=template_id, template_version=template_version, vcpus_per_node=vcpus_per_node,
+                         max_workers=max_workers), **pool)
+        if pool["vcpus_per_node"] is None:
+            pool["vcpus_per_node"] = cached_vcpus(pool["instance_type"])
+        if pool.get("memory") is None:
+            pool["memory"] = cached_memory(pool["instance_type"])
+        pools.append(pool)
+
+    return pools
+
+
+def new_run_id():
+    "Returns a random run id"
+    return str(hex(random.randint(1e10, 1e11-1)))
+
+
+def script_prefix(run_id):
+    "Returns the prefix of the scripts of a run in its bucket, so that runs sharing a bucket keep their own scripts"
+    return f"script/{run_id}/"
+
+
+def upload_user_entrypoint(s3_bucket_name, run_id, location="script", s3=boto3.resource("s3")):
+    """Uploads the user script to script/{run_id}/ on s3 bucket"""
     files = [os.path.join(dp, f) for dp, dn, fn in os.walk(os.path.expanduser(location)) for f in fn]
     for file in files:
-        s3.meta.client.upload_file(file, s3_bucket_name, f"script/{os.path.relpath(file, location)}")
+        s3.meta.client.upload_file(file, s3_bucket_name, f"{script_prefix(run_id)}{os.path.relpath(file, location)}")
 
 
-def upload_req_files(s3_bucket_name, s3=boto3.resource("s3"), combine_data="combine_data.py", points="points.py"):
-    """Uploads required scripts to s3 bucket"""
-    files = [combine_data, points, "worker_userdata.py"]
-    for file in files:
-        s3.meta.client.upload_file(file, s3_bucket_name, f"script/{file}")
+def upload_req_files(s3_bucket_name, run_id, s3=boto3.resource("s3"), combine_data="combine_data.py", points="points.py",
+                     templates=None):
+    """Uploads required scripts to s3 bucket
+
+    combine_data and points are uploaded to script/{run_id}/, and the userdata templates and the modules shared by
+    every run to script/. The templates shipped with mcc are uploaded unless `templates` gives the path of a
+    replacement by name, e.g. {"worker_userdata.py": "my_worker_userdata.py"}, which every run of the bucket then uses."""
+    unknown = set(templates or {}) - set(TEMPLATES)
+    if unknown:
+        raise ValueError(f"Unknown userdata templates {sorted(unknown)}, expected some of {TEMPLATES}")
+
+    for file in [combine_data, points]:
+        s3.meta.client.upload_file(file, s3_bucket_name, f"{script_prefix(run_id)}{file}")
+
+    for template in TEMPLATES:
+        s3.meta.client.upload_file(template_path(template, templates), s3_bucket_name, f"script/{template}")
+
+    for module in ["codec.py", "inputs.py", "profiling.py", "shards.py", "transport.py"]:
+        s3.meta.client.upload_file(os.path.join(os.path.dirname(__file__), module), s3_bucket_name, f"script/{module}")
+
+
+def submit_run(manager_id, run, redis_endpoint, redis_port=6379):
+    """Submits a run to an already running manager instance
+
+    The machine submitting the run must be able to reach the redis server.
+
+    Parameters
+    ----------
+    manager_id : string
+        Instance id of the running manager
+
+    run : dict
+        Run specification, see `launch_manager`
+
+    redis_endpoint : string or list
+        Address of the redis server shared by the manager, or the shards of its redis servers, see
+        `mcc.shards.parse_topology`. Runs are submitted to the home shard
+
+    redis_port : int, optional
+        Port of the redis server (Default: 6379)
+
+    Returns
+    -------
+    accepted : bool
+        False if the manager is no longer accepting runs
+    """
+    address, port = parse_topology(redis_endpoint, redis_port)[0]
+    rcache = redis.Redis(host=address, port=port, db=0)
+    with rcache.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(f"{manager_id}_accepting")
+                if not pipe.exists(f"{manager_id}_accepting"):
+                    return False
+                pipe.multi()
+                pipe.rpush(f"{manager_id}_submissions", json.dumps(run))
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
 
 
 def launch_manager(instance_type="t2.micro", template_id="", template_version="1", s3_bucket="",
                    worker_instance_type="t2.micro", worker_template_id="", worker_template_version="",
                    vcpus_per_node=None, hyperthreading=True, entry_point="", redis_endpoint="",
-                   redis_port=6379, ec2=boto3.resource("ec2")):
-    """Launches manager instance"""
+                   redis_port=6379, run_id=None, share=1, manager_id=None, idle_timeout=300, max_workers=None,
+                   max_queued=10000, compression=None, worker_pools=None, point_timeout=None, point_memory=None,
+                   max_retries=2, profile=None, profile_rate=100, inputs=None, warm_ttl=0, wait=True,
+                   ec2=boto3.resource("ec2")):
+    """Launches manager instance, or submits the run to an already running manager if `manager_id` is given
+
+    A manager hosts every run submitted to it while it is running, sharing its workers between runs in proportion
+    to their `share`, and stays up for `idle_timeout` seconds after its last run finishes to accept new runs.
+    The combined result of each run is uploaded to `results/{run_id}_{output_file}` in its `s3_bucket`.
+
+    The scripts of the run are read from `script/{run_id}/` in its `s3_bucket`, so `run_id` must be the one given to
+    `upload_user_entrypoint` and `upload_req_files`, see `new_run_id`.
+
+    `get_points` may return a generator, in which case at most `max_queued` points are held in redis at once and
+    workers are launched as points are queued, up to `max_workers` if given.
+
+    `compression` ("gzip" or "zstd") compresses partial results, combined results and logs while they are uploaded
+    to S3, adding the ".gz" or ".zst" extension to their keys.
+
+    `worker_pools` launches workers of several instance types for one run, see `make_worker_pools`. Each point is
+    routed to the first pool whose instances fit its resource hints, and is only run by workers of that pool. By
+    default, the run has a single pool of `worker_instance_type`, up to `max_workers`.
+
+    Each point is killed if it runs longer than `point_timeout` seconds, or a "timeout" resource hint of the point,
+    and cannot allocate more than `point_memory` MB, or a "memory" resource hint of the point. Points that fail, time
+    out or exit with a non-zero code are retried up to `max_retries` times, and are then uploaded to
+    `results/{run_id}.failed.json` instead of the result.
+
+    `profile` samples this fraction of the points with py-spy, `profile_rate` times a second, and times the phases of
+    the manager. The merged profile is uploaded next to the combined result as `results/{run_id}.profile.folded`,
+    in collapsed stacks format, and `results/{run_id}.profile.json`, see `mcc.analysis.load_profiles`.
+
+    `inputs` declares large read-only inputs of the entry point, as the S3 key in `s3_bucket` of each input by
+    name. They are downloaded once per worker node and memory mapped by every slot, see `mcc.inputs.load_input`.
+
+    Workers of a manager launched with `warm_ttl` park in a warm pool in redis for up to `warm_ttl` seconds when it
+    has no points left for them, instead of terminating. Managers adopt parked workers with the same launch
+    template and instance type before launching new ones, which skips the boot of the adopted instances.
+
+    `redis_endpoint` may be a list of independent redis servers, as returned by `mcc.templates.create_redis_server`
+    with `shards`, to spread the queue of large fleets over them. The first server is the home shard, which keeps the
+    state of managers and runs, and is the one to give to `mcc.monitor`.
+
+    If `wait` is False, returns as soon as the manager instance is requested instead of waiting until it is running.
+    """
+    if run_id is None:
+        raise ValueError("run_id is required, upload the scripts of the run under it with upload_req_files first")
+
     if not worker_template_id:
         worker_template_id = template_id
 
     if not worker_template_version:
         worker_template_version = template_version
 
-    if vcpus_per_node is None:
-        vcpus_per_node = get_ec2_vcpus(instance_type=worker_instance_type)
+    if worker_pools is None:
+        worker_pools = [dict(instance_type=worker_instance_type, vcpus_per_node=vcpus_per_node, max_workers=max_workers)]
+    worker_pools = make_worker_pools(worker_pools, worker_template_id, worker_template_version)
 
-    manager_data = dict(s3_bucket=s3_bucket, worker_template_id=worker_template_id, worker_instance_type=worker_instance_type,
-                        worker_template_version=worker_template_version, hyperthread_const=int(not hyperthreading) + 1,
-                        vcpus_per_node=vcpus_per_node, redis_endpoint=redis_endpoint, redis_port=redis_port,
-                        entry_point=entry_point)
+    run = dict(run_id=run_id, s3_bucket=s3_bucket, entry_point=entry_point, share=share,
+               worker_pools=worker_pools, hyperthread_const=int(not hyperthreading) + 1, max_queued=max_queued,
+               compression=compression, point_timeout=point_timeout, point_memory=point_memory, max_retries=max_retries,
+               profile=profile, profile_rate=profile_rate, inputs=inputs)
 
-    with open("manager_userdata.py", "r") as f:
-        userdata = f.read()
-        userdata = userdata.replace(r"{{manager_data}}", json.dumps(manager_data))
+    if manager_id is not None:
+        if submit_run(manager_id, run, redis_endpoint, redis_port):
+            logging.info(f"Run {run_id} submitted to Manager Instance {manager_id}")
+            return dict(Instance=ec2.Instance(manager_id), RunId=run_id)
+        logging.info(f"Manager Instance {manager_id} is no longer accepting runs, launching a new manager")
+
+    manager_data = dict(s3_bucket=s3_bucket, redis_topology=parse_topology(redis_endpoint, redis_port),
+                        idle_timeout=idle_timeout, compression=compression, warm_ttl=warm_ttl, run=run)
+
+    userdata = bootstrap_userdata(s3_bucket, "manager_userdata.py", r"{{manager_data}}", manager_data)
 
     launch = dict(LaunchTemplate={'LaunchTemplateId': template_id, 'Version': template_version}, UserData=userdata,
                   InstanceType=instance_type, MaxCount=1, MinCount=1, InstanceInitiatedShutdownBehavior="terminate")
 
     manager = ec2.create_instances(**launch)[0]
 
-    manager.wait_until_running()
-    manager.load()
+    if wait:
+        manager.wait_until_running()
+        manager.load()
+        logging.info(f"Manager Instance {manager.id} is operational!")
+
+    return dict(Instance=manager, UserData=userdata, RunId=run_id)
+
+
+class RunHandle:
+    """Handle of a run launched by `launch_runs`
+
+    The state of a run is "pending" until its manager is running, then "running" until its combined result is
+    uploaded ("completed"), or until it fails to start or to finish or its manager stops without uploading a result ("failed").
+    """
+    def __init__(self, run_id, s3_bucket, launch, executor, s3, poll_interval=30):
+        self.run_id = run_id
+        self.s3_bucket = s3_bucket
+        self.launch = launch
+        self.executor = executor
+        self.poll_interval = poll_interval
+        self.result_key = None
+        self.error = None
+        self.s3 = s3
+
+    def __repr__(self):
+        return f"<RunHandle {self.run_id}>"
+
+    async def _call(self, func, *args, **kwargs):
+        "Runs a blocking boto3 call in the executor"
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def instance(self):
+        "Returns the manager instance once it has been requested, raising if the launch failed"
+        return (await asyncio.wrap_future(self.launch))["Instance"]
+
+    def _find_result(self):
+        "Looks for the combined result, or the error recorded if the run failed"
+        response = self.s3.list_objects_v2(Bucket=self.s3_bucket, Prefix=f"results/{self.run_id}_", MaxKeys=1)
+        if response.get("Contents"):
+            self.result_key = response["Contents"][0]["Key"]
+            return "completed"
+
+        try:
+            error = self.s3.get_object(Bucket=self.s3_bucket, Key=f"results/{self.run_id}.error")
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        self.error = error["Body"].read().decode()
+        return "failed"
+
+    async def status(self):
+        "Returns the current state of the run"
+        if self.result_key is not None:
+            return "completed"
+        if self.error is not None:
+            return "failed"
+
+        if not self.launch.done():
+            return "pending"
+        if self.launch.exception() is not None:
+            self.error = repr(self.launch.exception())
+            return "failed"
+
+        instance = await self.instance()
+        state = await self._call(lambda: (instance.reload(), instance.state["Name"])[1])
+        if state == "pending":
+            return "pending"
+
+        result = await self._call(self._find_result)
+        if result is not None:
+            return result
+        if state in FINISHED_STATES:
+            self.error = f"Manager Instance {instance.id} is {state} without a result"
+            return "failed"
+
+        return "running"
+
+    async def running(self):
+        "Waits until the manager of the run is running, returning the manager instance"
+        instance = await self.instance()
+        await self._call(instance.wait_until_running)
+        await self._call(instance.load)
+        return instance
+
+    async def wait(self, timeout=None):
+        """Waits until the run is completed or failed
+
+        Returns
+        -------
+        key : string
+            Key of the combined result in the bucket of the run
+
+        Raises
+        ------
+        RuntimeError
+            If the run failed
+
+        asyncio.TimeoutError
+            If the run is not finished after `timeout` seconds
+        """
+        async def poll():
+            while True:
+                state = await self.status()
+                if state == "completed":
+                    return self.result_key
+                if state == "failed":
+                    raise RuntimeError(f"Run {self.run_id} failed: {self.error}")
+                await asyncio.sleep(self.poll_interval)
+
+        return await asyncio.wait_for(poll(), timeout)
+
+    async def result(self):
+        "Returns the bucket and key of the combined result, waiting until the run is completed"
+        return self.s3_bucket, await self.wait()
+
+
+async def launch_runs(runs, max_concurrency=16, poll_interval=30, **kwargs):
+    """Launches many runs concurrently without blocking the event loop
+
+    Parameters
+    ----------
+    runs : list{dict}
+        Arguments of `launch_manager` for each run, overriding the common `kwargs`, including the `run_id` its
+        scripts were uploaded under
+
+    max_concurrency : int, optional
+        Maximum number of launches and status polls in flight at once (Default: 16)
+
+    poll_interval : int, optional
+        Seconds between status polls while waiting on a handle (Default: 30)
+
+    Returns
+    -------
+    handles : list{RunHandle}
+        Handle of each run, in the order of `runs`, once every launch has been requested
+
+    Examples
+    --------
+    >>> handles = await launch_runs([dict(s3_bucket=bucket, run_id=run_id, entry_point="my_script.py")
+    ...                              for bucket, run_id in run_ids.items()],
+    ...                             template_id=template_id, redis_endpoint=redis_endpoint)
+    >>> keys = await asyncio.gather(*[handle.wait() for handle in handles])
+    """
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    s3 = boto3.session.Session().client("s3")
+    runs = [dict(kwargs, **run) for run in runs]
+    if any(run.get("run_id") is None for run in runs):
+        raise ValueError("Every run needs the run_id its scripts were uploaded under")
+
+    instance_types = {pool["instance_type"] for run in runs
+                      for pool in run.get("worker_pools") or [dict(instance_type=run.get("worker_instance_type", "t2.micro"))]}
+    await asyncio.gather(*[loop.run_in_executor(executor, cached, instance_type)
+                           for instance_type in instance_types for cached in [cached_vcpus, cached_memory]])
+
+    def launch(run):
+        return launch_manager(wait=False, ec2=boto3.session.Session().resource("ec2"), **run)
 
-    logging.info(f"Manager Instance {manager.id} is operational!")
+    handles = []
+    for run in runs:
+        handles.append(RunHandle(run["run_id"], run.get("s3_bucket", ""), executor.submit(launch, run), executor, s3,
+                                 poll_interval))
 
-    return dict(Instance=manager, UserData=userdata)
+    await asyncio.gather(*[asyncio.wrap_future(handle.launch) for handle in handles], return_exceptions=True)
+    return handles
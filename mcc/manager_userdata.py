@@ -1,10 +1,15 @@
 #!/opt/anaconda/bin/python
 """UserData Script for Manager Instance"""
+import heapq
+import importlib.util
+import itertools
 import json
 import logging
 import os
 import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import Thread
 import requests
 
 import boto3
@@ -15,6 +20,9 @@ import redis
 
 sys.path.append("/")
 
+LAUNCH_TIMEOUT = 900
+
+
 class LoggerWriter:
     def __init__(self, level):
         self.level = level
@@ -27,184 +35,770 @@ class LoggerWriter:
         self.level(sys.stderr)
 
 
-def check_stalled(in_progress, instances):
-    "Checks active instances for stalls"
-    stalled = []
-    for instance_id, info in in_progress.items():
-        last = arrow.get(info["check_in"])
-        now = arrow.utcnow()
-        tdelta = now - last
-        if tdelta.total_seconds() > 240:
-            instance = None
-            for inst in instances:
-                if inst.id == instance_id:
-                    instance = inst
-                    break
-            stalled.append((instance, info["points"]))
+def in_progress_points(worker_id, runs):
+    "Returns the points a worker has claimed in each run, as (shard, point) pairs"
+    points = {}
+    results = shards.gather(lambda pipe: [pipe.lrange(f"{run_id}_in_progress_{worker_id}", 0, -1) for run_id in runs])
+    for shard, shard_points in enumerate(results):
+        for run_id, run_points in zip(runs, shard_points):
+            if run_points:
+                points.setdefault(run_id, []).extend((shard, point) for point in run_points)
 
-    return stalled
+    return points
 
 
-logging.basicConfig(filename="manager.log", level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s", filemode="a")
-logger = logging.getLogger(__name__)
-sys.stdout = LoggerWriter(logger.debug)
-sys.stderr = LoggerWriter(logger.warning)
+def check_stalled(check_ins, runs):
+    """Checks active instances for stalls, returning the stalled instance ids and their points in each run, as
+    (shard, point) pairs"""
+    stalled = []
+    now = arrow.utcnow()
+    for worker_id, check_in in check_ins.items():
+        if (now - arrow.get(check_in["time"])).total_seconds() > 240:
+            points = in_progress_points(worker_id, runs)
+            if points:
+                stalled.append((worker_id, points))
 
-logging.info("START")
+    return stalled
 
-manager_data = json.loads("{{manager_data}}")
 
-logging.info(f"Hyperthreading = {not bool(manager_data['hyperthread_cost'] - 1)}")
+def requeue_points(worker_id, points):
+    "Returns the points claimed by a worker in each run to the queue of the pool they are routed to"
+    for shard, client in enumerate(shards):
+        shard_points = {run_id: [point for point_shard, point in run_points if point_shard == shard]
+                        for run_id, run_points in points.items()}
+        with client.pipeline(transaction=False) as pipe:
+            for run_id, run_points in shard_points.items():
+                for point in reversed(run_points):
+                    instance_type = route_point(runs[run_id], split_point(unpack_point(point))[1])
+                    pipe.rpoplpush(f"{run_id}_in_progress_{worker_id}", f"{run_id}_remaining_{instance_type}")
+            requeued = iter(pipe.execute())
+        for run_id, run_points in shard_points.items():
+            if run_points:
+                client.decr(f"{run_id}_active", sum(point is not None for point in itertools.islice(requeued, len(run_points))))
+
+
+def resweep_workers(worker_ids):
+    """Requeues the points that terminated workers claimed between being found stalled and being terminated, which
+    the sweep that found them stalled could not see"""
+    for worker_id in worker_ids:
+        points = in_progress_points(worker_id, runs)
+        if points:
+            logging.info(f"Terminated instance '{worker_id}' had claimed points "
+                         f"{ {run_id: [unpack_point(point) for _, point in run_points] for run_id, run_points in points.items()} }, returning them to queue")
+            requeue_points(worker_id, points)
+
+
+def load_module(path, name):
+    "Imports a python file downloaded for a run under a unique module name"
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def pool_worker_data(run, pool):
+    "Returns the worker data of the workers of a pool of a run"
+    return dict(worker_data, hyperthread_const=run['hyperthread_const'], template_id=pool['template_id'],
+                template_version=pool['template_version'])
+
+
+def worker_userdata(run, pool):
+    """Returns the UserData of the workers of a pool of a run, a stub that runs worker_userdata.py from the bucket
+
+    EC2 limits UserData to 16KB, which the worker script exceeds."""
+    bootstrap = dict(s3_bucket=manager_data['s3_bucket'], script="worker_userdata.py", placeholder=r"{{worker_data}}",
+                     data=pool_worker_data(run, pool))
+    return bootstrap_template.replace(r"{{bootstrap}}", repr(json.dumps(bootstrap)))
+
+
+def warm_pool_key(pool):
+    "Returns the redis list of parked workers that can join a pool"
+    return f"mcc_warm_{pool['template_id']}_{pool['template_version']}_{pool['instance_type']}"
+
+
+def adopt_workers(run, pool, count):
+    """Adopts up to count workers parked in the warm pool by earlier managers, returning their ids
+
+    Parked workers with the launch template and instance type of the pool are sent this manager's worker data on
+    their job channel, oldest first. Workers that are about to give up waiting are skipped."""
+    data = json.dumps(pool_worker_data(run, pool))
+    instances = []
+    while len(instances) < count:
+        parked = rcache.lpop(warm_pool_key(pool))
+        if parked is None:
+            break
+        parked = json.loads(parked)
+        if parked["until"] < time.time() + 10:
+            continue
+
+        with rcache.pipeline() as pipe:
+            pipe.rpush(f"mcc_warm_job_{parked['instance_id']}", data)
+            pipe.expire(f"mcc_warm_job_{parked['instance_id']}", 300)
+            pipe.execute()
+        registry[parked['instance_id']] = dict(run_id=run["run_id"], instance_type=pool['instance_type'], launched=time.time())
+        instances.append(parked['instance_id'])
+
+    if instances:
+        logging.info(f"Run {run['run_id']}: Manager adopted {len(instances)} '{pool['instance_type']}' Instances.")
+
+    return instances
+
+
+def launch_workers(run, pool, count):
+    """Launches up to count worker instances of a pool of a run, returning their ids
+
+    Any error of the launch (instance limits, insufficient capacity, unsupported instance types) launches nothing, so
+    that it is retried and fails the run after LAUNCH_TIMEOUT. Uses the thread-safe ec2 client, so that replacements
+    can be launched from the background executor."""
+    launch = dict(LaunchTemplate={'LaunchTemplateId': pool['template_id'], 'Version': pool['template_version']},
+                  InstanceType=pool['instance_type'], MaxCount=count, MinCount=1,
+                  InstanceInitiatedShutdownBehavior="terminate",
+                  UserData=worker_userdata(run, pool))
+    try:
+        instances = [instance["InstanceId"] for instance in ec2.meta.client.run_instances(**launch)["Instances"]]
+    except botocore.exceptions.ClientError as e:
+        logging.warning(f"Run {run['run_id']}: could not launch '{pool['instance_type']}' Instances: "
+                        f"{e.response['Error']['Code']} {e.response['Error'].get('Message', '')}")
+        instances = []
+
+    for worker_id in instances:
+        registry[worker_id] = dict(run_id=run["run_id"], instance_type=pool['instance_type'], launched=time.time())
+
+    return instances
+
+
+def get_pool(run, instance_type):
+    "Returns the worker pool of a run with the given instance type, or None"
+    return next((pool for pool in run["worker_pools"] if pool["instance_type"] == instance_type), None)
+
+
+def replace_workers(run, pool, count):
+    "Adopts or launches replacements for stalled workers of a pool of a run"
+    adopted = adopt_workers(run, pool, count)
+    if count > len(adopted):
+        instances = launch_workers(run, pool, count - len(adopted))
+        logging.info(f"Run {run['run_id']}: Manager launched {len(instances)} '{pool['instance_type']}' Instances.")
+
+
+def terminate_workers(worker_ids):
+    "Terminates stalled workers, returning once they can no longer claim points"
+    ec2.meta.client.terminate_instances(InstanceIds=worker_ids)
+    ec2.meta.client.get_waiter("instance_terminated").wait(InstanceIds=worker_ids)
+    logging.info(f"Terminated stalled instances {worker_ids}")
 
-ec2 = boto3.resource("ec2")
-s3 = boto3.resource("s3")
 
-for file in ["userdata_template", "points", "combine_data_template"]:
-    response = s3.meta.client.download_file(manager_data['s3_bucket'], f"script/{file}.py", f"{file}.py")
+def in_background(func, *args):
+    "Runs func in the background executor, logging any exception it raises"
+    def log_exception(future):
+        if future.exception() is not None:
+            logging.error(f"{func.__name__}{args} failed: {future.exception()!r}")
+
+    background.submit(func, *args).add_done_callback(log_exception)
+
+
+def target_workers(run, pool):
+    """Number of workers a pool of a run needs for the points routed to it so far
+
+    A run with a single pool sizes it for all of its points if they are known up front."""
+    if len(run["worker_pools"]) == 1:
+        total = run["_size"] if run["_size"] is not None else int(rcache.get(f"{run['run_id']}_total") or 0)
+    else:
+        total = run["_pool_totals"][pool['instance_type']]
+        if not total:
+            return 0
+
+    target = total // pool['vcpus_per_node'] * run['hyperthread_const'] + 1
+    if pool.get('max_workers'):
+        target = min(target, pool['max_workers'])
+    return target
+
+
+def scale_workers(run):
+    "Adopts parked workers or launches new ones for each pool of a run as points are routed to it"
+    for pool in run["worker_pools"]:
+        instance_type = pool['instance_type']
+        count = target_workers(run, pool) - run["_launched"][instance_type]
+        if count > 0:
+            adopted = adopt_workers(run, pool, count)
+            run["_launched"][instance_type] += len(adopted)
+            count -= len(adopted)
+        if count > 0:
+            instances = launch_workers(run, pool, count)
+            run["_launched"][instance_type] += len(instances)
+            if instances:
+                logging.info(f"Run {run['run_id']}: Manager launched {len(instances)} '{instance_type}' Instances.")
+                run["_launch_failed"] = None
+            else:
+                logging.error(f"Manager failed to launch any '{instance_type}' instances, retrying")
+                if not any(run["_launched"].values()) and run["_launch_failed"] is None:
+                    run["_launch_failed"] = time.time()
+
+
+def route_point(run, resources):
+    """Returns the instance type of the first pool of a run whose instances fit the resource hints of a point
+
+    Points that fit no pool are routed to the pool with the most memory."""
+    memory, cpus = resources.get("memory", 0), resources.get("cpus", 1)
+    for pool in run["worker_pools"]:
+        if memory <= pool["memory"] and cpus <= pool["vcpus_per_node"]:
+            return pool["instance_type"]
+
+    pool = max(run["worker_pools"], key=lambda pool: pool["memory"])
+    logging.warning(f"Run {run['run_id']}: no worker pool fits resources {resources}, routing to '{pool['instance_type']}'")
+    return pool["instance_type"]
+
+
+def start_run(run):
+    "Starts feeding the points of a run into its queue"
+    run_id = run["run_id"]
+    run_dir = os.path.join("runs", run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    for file in ["points", "combine_data"]:
+        s3.meta.client.download_file(run['s3_bucket'], f"script/{run_id}/{file}.py", os.path.join(run_dir, f"{file}.py"))
+
+    points = load_module(os.path.join(run_dir, "points.py"), f"points_{run_id}").get_points()
+
+    rcache.set(f"{run_id}_total", 0)
+    for client in shards:
+        client.set(f"{run_id}_completed", 0)
+        client.set(f"{run_id}_active", 0)
+    rcache.hset(f"{instance_id}_runs", run_id, json.dumps(run))
+
+    size = len(points) if hasattr(points, "__len__") else None
+    combine = load_module(os.path.join(run_dir, "combine_data.py"), f"combine_data_{run_id}")
+    os.makedirs(f"results/{run_id}", exist_ok=True)
+    runs[run_id] = dict(run, _points=iter(points), _size=size, _combine=combine, _partial=None, _partials=0,
+                        _launched={pool['instance_type']: 0 for pool in run["worker_pools"]},
+                        _pool_totals={pool['instance_type']: 0 for pool in run["worker_pools"]}, _counts=(0, 0, 0, 0), _shard=0, _launch_failed=None, _error=None,
+                        _started=str(arrow.utcnow()), _timer=PhaseTimer())
+
+    logging.info(f"Run {run_id} started with {size if size is not None else 'streamed'} points")
+    logging.info(f"Run {run_id}: Hyperthreading = {not bool(run['hyperthread_const'] - 1)}")
+
+    scale_workers(runs[run_id])
+
+
+def record_error(run, message):
+    "Records a run as failed in its bucket, where `mcc.launch.RunHandle` looks for it"
+    s3.meta.client.put_object(Bucket=run['s3_bucket'], Key=f"results/{run['run_id']}.error", Body=message.encode())
+
+
+def clear_run(run):
+    "Deletes the keys of a run from every shard"
+    run_id = run["run_id"]
+    for client in shards:
+        for worker_id in client.smembers(f"{run_id}_workers"):
+            client.delete(f"{run_id}_in_progress_{worker_id.decode()}")
+        for key in ["completed", "active", "workers", "uploaded", "attempts"]:
+            client.delete(f"{run_id}_{key}")
+        for pool in run["worker_pools"]:
+            client.delete(f"{run_id}_remaining_{pool['instance_type']}")
+    for key in ["total", "exhausted", "dead"]:
+        rcache.delete(f"{run_id}_{key}")
+    rcache.hdel(f"{instance_id}_runs", run_id)
+
+
+def fail_run(run, message):
+    "Stops a run that cannot complete, recording it as failed in its bucket"
+    logging.error(f"Run {run['run_id']} failed: {message}")
+    runs.pop(run["run_id"], None)
+    run["_points"] = None
+    clear_run(run)
+    record_error(run, message)
+
+
+def try_start_run(run):
+    "Starts a run, recording it as failed in its bucket if it cannot be started"
+    run_id = run["run_id"]
+    try:
+        start_run(run)
+    except Exception as e:
+        logging.exception(f"Run {run_id} failed to start")
+        runs.pop(run_id, None)
+        clear_run(run)
+        record_error(run, f"{type(e).__name__}: {e}")
+
+
+def feed_points():
+    """Feeds the points of each run into the queue partition of their worker pool in bounded batches, pausing while
+    the partitions of a run are full
+
+    Batches are spread over the shards in turn, so that each shard queues a similar number of points."""
+    while True:
+        fed = False
+        for run_id, run in list(runs.items()):
+            if run["_points"] is None:
+                continue
+
+            max_queued = run.get("max_queued", 10000)
+            queued = sum(map(sum, shards.gather(lambda pipe: [pipe.llen(f"{run_id}_remaining_{instance_type}")
+                                                              for instance_type in run["_pool_totals"]])))
+            if queued > max_queued // 2:
+                continue
+
+            batches = {instance_type: [] for instance_type in run["_pool_totals"]}
+            size = 0
+            try:
+                for point in itertools.islice(run["_points"], max_queued - queued):
+                    size += 1
+                    batches[route_point(run, split_point(point)[1])].append(pack_point(point))
+            except Exception as e:
+                logging.exception(f"Run {run_id}: get_points() failed")
+                run["_points"] = None
+                run["_error"] = f"get_points() failed: {type(e).__name__}: {e}"
+                continue
+
+            for instance_type, batch in batches.items():
+                for i in range(0, len(batch), 1000):
+                    shards[run["_shard"]].lpush(f"{run_id}_remaining_{instance_type}", *batch[i:i + 1000])
+                    rcache.incrby(f"{run_id}_total", len(batch[i:i + 1000]))
+                    run["_shard"] = (run["_shard"] + 1) % len(shards)
+                run["_pool_totals"][instance_type] += len(batch)
+
+            if size < max_queued - queued:
+                run["_points"] = None
+                rcache.set(f"{run_id}_exhausted", 1)
+                logging.info(f"Run {run_id}: all {int(rcache.get(f'{run_id}_total'))} points queued")
+            fed = fed or bool(size)
+
+        if not fed:
+            time.sleep(1)
+
+
+def uploads_complete(run_id, check_ins):
+    "Checks that every live worker which took points from a run, on any shard, has uploaded its results"
+    pending = set()
+    for participants, uploaded in shards.gather(lambda pipe: [pipe.smembers(f"{run_id}_workers"), pipe.smembers(f"{run_id}_uploaded")]):
+        pending |= {worker_id.decode() for worker_id in participants - uploaded}
+    return not (pending - terminated) & set(check_ins)
+
+
+def result_files(run, workers=None):
+    "Lists the partial data files of a run in S3, optionally only those uploaded by the given workers"
+    files = []
+    for obj in s3.Bucket(run['s3_bucket']).objects.filter(Prefix=f"results/{run['run_id']}/"):
+        name = strip_extension(os.path.basename(obj.key))
+        if any(name.endswith(f".{file_extension}") for file_extension in run["_combine"].file_extensions):
+            if workers is None or name.split(".")[0] in workers:
+                files.append(obj.key)
+
+    return files
+
+
+def combine_group(module_name, files, fileout):
+    """Combines files with the combine hook of a run
+
+    combine_data reads paths, so compressed files are decompressed to disk first. Each compressed file is removed as
+    soon as it is decompressed, so that only one file at a time is on disk twice, and the decompressed copies are
+    removed once combined."""
+    paths = []
+    try:
+        for file in files:
+            paths.append(decompress_file(file))
+            if paths[-1] != file:
+                os.remove(file)
+        sys.modules[module_name].combine_data(paths, fileout)
+    finally:
+        for file, path in zip(files, paths):
+            if path != file:
+                os.remove(path)
+
+
+def combine_tree(combine, files, fileout, fan_in=8):
+    "Combines files in parallel groups of fan_in, then combines the outputs of the groups, until one file remains"
+    name, extension = os.path.splitext(fileout)
+    level = 0
+    inputs = list(files)
+    while len(inputs) > fan_in:
+        groups = [inputs[i:i + fan_in] for i in range(0, len(inputs), fan_in)]
+        outputs = [f"{name}.level{level}_{i}{extension}" for i in range(len(groups))]
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(combine_group, [combine.__name__] * len(groups), groups, outputs))
+        if level > 0:
+            for file in inputs:
+                os.remove(file)
+        inputs = outputs
+        level += 1
+
+    combine_group(combine.__name__, inputs, fileout)
+    if level > 0:
+        for file in inputs:
+            os.remove(file)
+
+
+def download_files(run, files):
+    "Downloads files of a run from S3 in parallel"
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(lambda file: s3.meta.client.download_file(run['s3_bucket'], file, file), files))
+
+
+def delete_files(run, files):
+    "Deletes local and S3 copies of files of a run"
+    for file in files:
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        s3.meta.client.delete_object(Bucket=run['s3_bucket'], Key=file)
+
+
+def partial_combine(run, files):
+    "Pre-aggregates per-node results of finished workers into one partial file while the run is still going"
+    run_id = run["run_id"]
+    run["_partials"] += 1
+    extension = os.path.splitext(run["_combine"].output_file)[1]
+    fileout = f"results/{run_id}/partial_{run['_partials']}{extension}"
+
+    logging.info(f"Run {run_id}: Pre-aggregating {len(files)} Partial Data Files into '{fileout}'")
+    download_files(run, files)
+    combine_tree(run["_combine"], files, fileout)
+    upload_file(s3.meta.client, fileout, run['s3_bucket'], fileout, run.get('compression'))
+    os.remove(fileout)
+    delete_files(run, files)
+
+
+def pre_aggregate(run, fan_in=8):
+    """Starts pre-aggregating results if enough workers of a run have finished and uploaded for good
+
+    Fails the run if its last pre-aggregation failed, like `try_finish_run` does for the final combine."""
+    if not getattr(run["_combine"], "supports_partial", False):
+        return
+    if run["_partial"] is not None and not run["_partial"].done():
+        return
+    if run["_partial"] is not None and run["_partial"].exception() is not None:
+        e = run["_partial"].exception()
+        logging.error(f"Run {run['run_id']} failed to pre-aggregate", exc_info=e)
+        fail_run(run, f"{type(e).__name__}: {e}")
+        return
+
+    finished = {worker_id.decode() for worker_id in rcache.smembers(f"{instance_id}_finished")} | terminated
+    files = result_files(run, finished)
+    if len(files) >= fan_in:
+        run["_partial"] = combiner.submit(partial_combine, run, files)
+
+
+def finish_run(run):
+    "Combines and uploads the results of a completed run"
+    run_id = run["run_id"]
+
+    dead = [unpack_point(point) for point in rcache.lrange(f"{run_id}_dead", 0, -1)]
+    clear_run(run)
+
+    logging.info(f"Run {run_id}: No Points Remaining.")
+
+    if dead:
+        logging.warning(f"Run {run_id}: {len(dead)} points failed, uploading them to results/{run_id}.failed.json")
+        s3.meta.client.put_object(Bucket=run['s3_bucket'], Key=f"results/{run_id}.failed.json",
+                                  Body=json.dumps(dead, default=lambda obj: obj.tolist() if hasattr(obj, "tolist") else str(obj)).encode())
+
+    if run["_partial"] is not None:
+        run["_partial"].result()
+
+    combine = run["_combine"]
+    files = result_files(run)
+
+    logging.info(f"Run {run_id}: Combining {len(files)} Partial Data Files")
+    with run["_timer"].phase("download"):
+        download_files(run, files)
+
+    fileout = f"results/{run_id}_{combine.output_file}"
 
-from points import get_points
-points = get_points()
+    with run["_timer"].phase("combine"):
+        if getattr(combine, "supports_partial", False):
+            combine_tree(combine, files, fileout)
+        else:
+            combine_group(combine.__name__, files, fileout)
 
-instance_id = requests.get("http://169.254.169.254/latest/meta-data/instance-id").text
+    if run.get("profile"):
+        upload_profile(run)
 
-rcache = redis.Redis(host=manager_data['redis_endpoint'], port=manager_data['redis_port'], db=0)
-rcache.set(f"{instance_id}_all", json.dumps(points))
-rcache.set(f"{instance_id}_remaining", json.dumps(points))
-rcache.set(f"{instance_id}_completed", json.dumps([]))
-rcache.set(f"{instance_id}_in_progress", json.dumps({}))
+    key = upload_file(s3.meta.client, fileout, run['s3_bucket'], fileout, run.get('compression'))
+    logging.info(f"Run {run_id}: Uploaded combined data file '{key}' to S3 bucket")
 
-worker_data = dict(s3_bucket=manager_data['s3_bucket'], entry_point=manager_data['entry_point'],
-                   manager_instance_id=instance_id, hyperthread_const=manager_data['hyperthread_const'],
-                   redis_endpoint=manager_data['redis_endpoint'], redis_port=manager_data['redis_port'])
+    delete_files(run, files)
+    os.remove(fileout)
 
-with open("worker_userdata.py", "r") as f:
-    userdata = f.read()
-    userdata = userdata.replace(r"{{worker_data}}", json.dumps(worker_data))
+    logging.info(f"Run {run_id} finished")
 
-launch = dict(LaunchTemplate={'LaunchTemplateId': manager_data['worker_template_id'], 'Version': manager_data['worker_template_version']},
-              InstanceType=manager_data['worker_instance_type'], MaxCount=len(points) // manager_data['vcpus_per_node'] * manager_data['hyperthread_cost'] + 1,
-              MinCount=1, InstanceInitiatedShutdownBehavior="terminate", UserData=userdata)
 
-try:
-    instances = ec2.create_instances(**launch)
-except botocore.exceptions.ClientError as e:
-    if e.response["Error"]["Code"] != "InstanceLimitExceeded":
-        raise e
+def try_finish_run(run):
+    """Finishes a run, recording it as failed in its bucket if it cannot be finished
 
-if not instances:
-    logging.error(f"Manager failed to launch any '{manager_data['worker_instance_type']}' instances!")
-    s3.meta.client.upload_file("manager.log", manager_data['s3_bucket'], f"results/{instance_id}_manager.log")
-    ec2.meta.client.describe_instances(InstanceIds=[instance_id])[0].terminate()
+    Runs on the combiner, so that neither a slow nor a failing combine holds up the other runs of the manager."""
+    try:
+        finish_run(run)
+    except Exception as e:
+        logging.exception(f"Run {run['run_id']} failed to finish")
+        record_error(run, f"{type(e).__name__}: {e}")
+
+
+def upload_profile(run):
+    """Merges the profiles uploaded by the workers of a run with the timings of the manager phases, and uploads
+    them next to the combined result as `results/{run_id}.profile.folded` and `results/{run_id}.profile.json`"""
+    run_id = run["run_id"]
+    keys = [obj.key for obj in s3.Bucket(run['s3_bucket']).objects.filter(Prefix=f"results/{run_id}/profiles/")]
+    os.makedirs(f"results/{run_id}/profiles", exist_ok=True)
+    download_files(run, keys)
+
+    paths = sorted({key[:-len(".json")] for key in keys if key.endswith(".json")})
+    profile = merge_profiles([read_profile(path) for path in paths if f"{path}.folded" in keys])
+    profile.update(rate=run.get("profile_rate", 100), phases=run["_timer"].as_dict(), loop={instance_id: loop_timer.as_dict()})
+
+    for file in write_profile(profile, f"results/{run_id}.profile"):
+        s3.meta.client.upload_file(file, run['s3_bucket'], file)
+        os.remove(file)
+    logging.info(f"Run {run_id}: Uploaded profile of {len(profile['points'])} points")
+
+    delete_files(run, keys)
+
+
+def read_records(file):
+    "Streams the records of a log file, keeping continuation lines such as tracebacks with their record"
+    with open_file(file, "r") as f:
+        record = ""
+        for line in f:
+            if record and line[:4].isdigit():
+                yield record
+                record = ""
+            record += line
+        if record:
+            yield record
+
+
+def merge_logs(files, out, max_open=256):
+    """Merges time-ordered log files into the binary stream out with a streaming heap merge, holding one record per
+    file in memory
+
+    Files are first merged in groups if there are more than max_open of them."""
+    files = list(files)
+    level = 0
+    while len(files) > max_open:
+        merged = []
+        for i in range(0, len(files), max_open):
+            merged.append(f"{files[i]}.merged{level}_{i}")
+            with open(merged[-1], "wb") as f:
+                merge_logs(files[i:i + max_open], f, max_open)
+            if level > 0:
+                for file in files[i:i + max_open]:
+                    os.remove(file)
+        files = merged
+        level += 1
+
+    for record in heapq.merge(*[read_records(file) for file in files], key=lambda record: record[:23]):
+        out.write(record.encode())
+
+    if level > 0:
+        for file in files:
+            os.remove(file)
+
+
+def publish_status(check_ins, stalled, counts, finished=None):
+    """Publishes one compact snapshot of every run and instance on this manager for `mcc.monitor`, including the
+    final counts of the runs `finished` since the last snapshot
+
+    The snapshot is also kept in the 'mcc_status' hash, so that monitors which start later see it immediately."""
+    hosted = dict(runs, **(finished or {}))
+    status = dict(manager_id=instance_id, time=str(arrow.utcnow()),
+                  runs={run_id: dict(zip(["completed", "total", "exhausted", "in_progress", "failed"], counts[run_id]),
+                                     started=run["_started"], share=run.get("share", 1)) for run_id, run in hosted.items() if run_id in counts},
+                  instances=check_ins,
+                  stalled=[dict(instance_id=worker_id, points={run_id: len(run_points) for run_id, run_points in points.items()})
+                           for worker_id, points in stalled])
+    status = json.dumps(status)
+    with rcache.pipeline(transaction=False) as pipe:
+        pipe.hset("mcc_status", instance_id, status)
+        pipe.publish("mcc_status", status)
+        pipe.execute()
+
+
+def submit_pending():
+    "Starts runs submitted to this manager by `mcc.launch.launch_manager`"
+    while True:
+        run = rcache.lpop(f"{instance_id}_submissions")
+        if run is None:
+            break
+        try_start_run(json.loads(run))
+
+
+def close_submissions():
+    "Stops accepting new runs, returning False if a run was submitted in the meantime"
+    with rcache.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(f"{instance_id}_submissions")
+                if pipe.llen(f"{instance_id}_submissions"):
+                    return False
+                pipe.multi()
+                pipe.delete(f"{instance_id}_accepting")
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                continue
 
-logging.info(f"Manager launched {len(instances)} '{manager_data['worker_instance_type']}' Instances.")
 
-remaining_points = json.loads(rcache.get(f"{instance_id}_remaining"))
-completed_points = json.loads(rcache.get(f"{instance_id}_completed"))
-all_points = json.loads(rcache.get(f"{instance_id}_all"))
+logging.basicConfig(filename="manager.log", level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name)s:%(message)s", filemode="a")
+logger = logging.getLogger(__name__)
+sys.stdout = LoggerWriter(logger.debug)
+sys.stderr = LoggerWriter(logger.warning)
 
-_points_in_progress = 0
-_completed = 0
-_stalled = 0
+logging.info("START")
 
-while len(completed_points) < len(all_points):
-    time.sleep(30)
-    completed_points = json.loads(rcache.get(f"{instance_id}_completed"))
-    in_progress = json.loads(rcache.get(f"{instance_id}_in_progress"))
-    points_in_progress = []
-
-    for inst, info in in_progress.items():
-        for point in info.get("points", []):
-            points_in_progress.append(point)
-
-    stalled = check_stalled(in_progress, instances)
-
-    logging.debug(str(in_progress))
-
-    if len(points_in_progress) != _points_in_progress or len(completed_points) != _completed or len(stalled) != _stalled:
-        _points_in_progress, _completed, _stalled = len(points_in_progress), len(completed_points), len(stalled)
-        logging.info(f"completed: {_completed}  in_progress: {_points_in_progress}  stalled: {_stalled}")
-
-    for instance, points in stalled:
-        if len(points) > 0:
-            logging.info(f"Instance '{instance.id}' has stalled, returning points {points} to queue and terminating")
-            instance.terminate()
-            instance.wait_until_terminated()
-            with rcache.pipeline() as pipe:
-                while 1:
-                    try:
-                        pipe.watch(f"{instance_id}_remaining")
-                        pipe.watch(f"{instance_id}_in_progress")
-                        remaining = json.loads(pipe.get(f"{instance_id}_remaining"))
-                        in_progress = json.loads(pipe.get(f"{instance_id}_in_progress"))
-                        del in_progress[instance.id]
-                        for point in points:
-                            remaining.append(point)
-                        pipe.multi()
-                        pipe.set(f"{instance_id}_remaining", json.dumps(remaining))
-                        pipe.set(f"{instance_id}_in_progress", json.dumps(in_progress))
-                        pipe.execute()
-                        break
-                    except redis.WatchError:
-                        continue
-            try:
-                instances.append(ec2.create_instances(**launch)[0])
-            except botocore.exceptions.ClientError as e:
-                if e.response["Error"]["Code"] == "InstanceLimitExceeded":
-                    continue
+manager_data = json.loads({{manager_data}})
 
-rcache.delete(f"{instance_id}_remaining")
-rcache.delete(f"{instance_id}_completed")
-rcache.delete(f"{instance_id}_in_progress")
-rcache.delete(f"{instance_id}_all")
+ec2 = boto3.resource("ec2")
+s3 = boto3.resource("s3")
 
-logging.info("No Points Remaining.")
+for file in ["bootstrap_userdata", "codec", "profiling", "shards", "transport"]:
+    s3.meta.client.download_file(manager_data['s3_bucket'], f"script/{file}.py", f"{file}.py")
 
-from combine_data import combine_data, file_extensions, output_file
+from codec import pack_point, split_point, unpack_point
+from profiling import PhaseTimer, merge_profiles, read_profile, write_profile
+from shards import Shards
+from transport import MultipartWriter, decompress_file, open_file, strip_extension, upload_file
 
-files = []
-for file_extension in file_extensions:
-    files.extend([obj.key for obj in s3.Bucket(manager_data['s3_bucket']).objects.all() if obj.key.startswith(f"results/{instance_id}") and obj.key.endswith(f".{file_extension}")])
+instance_id = requests.get("http://169.254.169.254/latest/meta-data/instance-id").text
 
-logging.info(f"Combining {len(files)} Partial Data Files")
-os.makedirs(f"results/{instance_id}")
-for file in files:
-    response = s3.meta.client.download_file(manager_data['s3_bucket'], file, file)
+shards = Shards(manager_data['redis_topology'])
+rcache = shards.home
 
-fileout = f"results/{instance_id}_{output_file}"
+worker_data = dict(s3_bucket=manager_data['s3_bucket'], manager_instance_id=instance_id, redis_topology=shards.topology,
+                   compression=manager_data.get('compression'), warm_ttl=manager_data.get('warm_ttl', 0))
 
-combine_data(files, fileout)
+with open("bootstrap_userdata.py", "r") as f:
+    bootstrap_template = f.read()
 
-logging.info(f"Uploading combined data file '{fileout}' to S3 bucket")
-response = s3.meta.client.upload_file(fileout, manager_data['s3_bucket'], f"{fileout}")
+runs = {}
+registry = {}
+terminated = set()
+combiner = ThreadPoolExecutor(max_workers=1)
+finishing = []
+terminating = []
+background = ThreadPoolExecutor(max_workers=8)
+loop_timer = PhaseTimer()
 
-for file in files:
-    try:
-        os.remove(file)
-        response = s3.meta.client.delete_object(Bucket=manager_data['s3_bucket'], Key=file)
-    except FileNotFoundError:
-        pass
+rcache.set(f"{instance_id}_accepting", 1, ex=manager_data['idle_timeout'] + 120)
+try_start_run(manager_data['run'])
+
+feeder = Thread(target=feed_points, daemon=True)
+feeder.start()
 
-log_files = [obj.key for obj in s3.Bucket(manager_data['s3_bucket']).objects.all() if obj.key.startswith(f"results/{instance_id}") and obj.key.endswith(f".log")]
+idle_since = None
+while True:
+    time.sleep(30)
+    with loop_timer.phase("submissions"):
+        rcache.expire(f"{instance_id}_accepting", manager_data['idle_timeout'] + 120)
+        submit_pending()
+
+    with loop_timer.phase("check_ins"):
+        check_ins = {worker_id.decode(): json.loads(check_in) for worker_id, check_in in rcache.hgetall(f"{instance_id}_check_in").items()}
+        stalled = check_stalled(check_ins, runs)
+
+    with loop_timer.phase("stalls"):
+        replacements = {}
+        for worker_id, points in stalled:
+            logging.info(f"Instance '{worker_id}' has stalled, returning points "
+                         f"{ {run_id: [unpack_point(point) for _, point in run_points] for run_id, run_points in points.items()} } to queue and terminating")
+            terminated.add(worker_id)
+            rcache.hdel(f"{instance_id}_check_in", worker_id)
+            requeue_points(worker_id, points)
+
+            worker = registry.get(worker_id, {})
+            run_id = worker.get("run_id") if worker.get("run_id") in runs else next(iter(points), None)
+            instance_type = worker.get("instance_type", check_ins[worker_id].get("instance_type"))
+            if run_id is not None and get_pool(runs[run_id], instance_type) is not None:
+                replacements[run_id, instance_type] = replacements.get((run_id, instance_type), 0) + 1
+
+        if stalled:
+            worker_ids = [worker_id for worker_id, _ in stalled]
+            terminating.append((worker_ids, background.submit(terminate_workers, worker_ids)))
+
+        terminated_workers = [(worker_ids, future) for worker_ids, future in terminating if future.done()]
+        terminating = [termination for termination in terminating if termination not in terminated_workers]
+        for worker_ids, future in terminated_workers:
+            if future.exception() is not None:
+                logging.error(f"terminate_workers({worker_ids},) failed: {future.exception()!r}")
+            resweep_workers(worker_ids)
+        for (run_id, instance_type), count in replacements.items():
+            in_background(replace_workers, runs[run_id], get_pool(runs[run_id], instance_type), count)
+
+    counts = {}
+    finished = {}
+    for run_id, run in list(runs.items()):
+        if run["_error"] is not None:
+            fail_run(run, run["_error"])
+            continue
+        with run["_timer"].phase("scale"):
+            scale_workers(run)
+        if run["_launch_failed"] is not None and time.time() - run["_launch_failed"] > LAUNCH_TIMEOUT:
+            fail_run(run, f"no worker instances could be launched for {LAUNCH_TIMEOUT}s")
+            continue
+        with run["_timer"].phase("pre_aggregate"):
+            pre_aggregate(run)
+        if run_id not in runs:
+            continue
+
+        with run["_timer"].phase("counts"):
+            with rcache.pipeline(transaction=False) as pipe:
+                pipe.get(f"{run_id}_total")
+                pipe.get(f"{run_id}_exhausted")
+                pipe.llen(f"{run_id}_dead")
+                total, exhausted, dead = pipe.execute()
+            shard_counts = shards.gather(lambda pipe: [pipe.get(f"{run_id}_completed"), pipe.get(f"{run_id}_active")])
+        completed = sum(int(shard_completed or 0) for shard_completed, _ in shard_counts)
+        points_in_progress = sum(int(shard_active or 0) for _, shard_active in shard_counts)
+        total = int(total)
+        counts[run_id] = (completed, total, bool(exhausted), points_in_progress, dead)
+        run_stalled = sum(1 for worker_id, points in stalled if run_id in points)
+
+        if run["_counts"] != (points_in_progress, completed, run_stalled, dead):
+            run["_counts"] = (points_in_progress, completed, run_stalled, dead)
+            logging.info(f"Run {run_id}: completed: {completed}  in_progress: {points_in_progress}  stalled: {run_stalled}  failed: {dead}")
+
+        if exhausted and completed + dead >= total and uploads_complete(run_id, check_ins):
+            finished[run_id] = runs.pop(run_id)
+            finishing.append(combiner.submit(try_finish_run, run))
+
+    with loop_timer.phase("publish"):
+        publish_status(check_ins, stalled, counts, finished)
+
+    finishing = [future for future in finishing if not future.done()]
+    if runs or finishing:
+        idle_since = None
+    elif idle_since is None:
+        idle_since = time.time()
+    elif time.time() - idle_since > manager_data['idle_timeout'] and close_submissions():
+        break
+
+logging.info("All runs complete.")
+
+workers = {worker_id.decode() for worker_id in rcache.smembers(f"{instance_id}_workers")}
+deadline = time.time() + 600
+while workers - {worker_id.decode() for worker_id in rcache.smembers(f"{instance_id}_finished")} - terminated and time.time() < deadline:
+    time.sleep(10)
+
+log_files = [obj.key for obj in s3.Bucket(manager_data['s3_bucket']).objects.filter(Prefix=f"results/{instance_id}/")
+             if strip_extension(obj.key).endswith(".log")]
 logging.info(f"Combining {len(log_files)} Worker Logs")
 
-worker_log_lines = []
-for file in log_files:
-    s3.meta.client.download_file(manager_data['s3_bucket'], file, file)
-    with open(file, "r") as f:
-        worker_log_lines.extend(f.readlines())
-    os.remove(file)
-    response = s3.meta.client.delete_object(Bucket=manager_data['s3_bucket'], Key=file)
+os.makedirs(f"results/{instance_id}", exist_ok=True)
+download_files(manager_data, log_files)
+
+with MultipartWriter(s3.meta.client, manager_data['s3_bucket'], f"results/{instance_id}_workers.log", manager_data.get('compression')) as f:
+    merge_logs(log_files, f)
 
-worker_log_lines.sort()
+delete_files(manager_data, log_files)
 
-with open("workers.log", "a") as f:
-    f.write("".join(worker_log_lines))
+for key in ["check_in", "runs", "workers", "finished", "submissions"]:
+    rcache.delete(f"{instance_id}_{key}")
+rcache.hdel("mcc_status", instance_id)
+background.shutdown(wait=True)
+combiner.shutdown(wait=True)
 
 logging.info("END")
 
-s3.meta.client.upload_file("manager.log", manager_data['s3_bucket'], f"results/{instance_id}_manager.log")
-s3.meta.client.upload_file("workers.log", manager_data['s3_bucket'], f"results/{instance_id}_workers.log")
+upload_file(s3.meta.client, "manager.log", manager_data['s3_bucket'], f"results/{instance_id}_manager.log", manager_data.get('compression'))
 
 os.removedirs(f"results/{instance_id}")
 
-ec2.meta.client.describe_instances(InstanceIds=[instance_id])[0].terminate()
+ec2.Instance(instance_id).terminate()
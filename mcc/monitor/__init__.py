@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""Live monitor of runs in progress"""
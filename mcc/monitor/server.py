@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""Live run monitor server
+
+Managers publish a compact snapshot of their runs and instances to the 'mcc_status' redis channel every loop, and
+keep the latest one in the 'mcc_status' hash. The monitor reads the hash once at startup and then only listens to
+the channel, so its load on redis is one subscription however many viewers are connected. Viewers get the
+current state as JSON from `/runs`, and live updates as server-sent events from `/events`.
+"""
+import asyncio
+import collections
+import json
+import logging
+
+import arrow
+import click
+import redis.asyncio
+
+CHANNEL = "mcc_status"
+
+
+class Monitor:
+    """State of every active run, built from manager snapshots
+
+    Throughput is measured over the completed counts of the last `window` seconds of snapshots, and the
+    most recent `max_events` stall events are kept."""
+    def __init__(self, window=600, max_events=100, stale=300):
+        self.window = window
+        self.stale = stale
+        self.managers = {}
+        self.history = collections.defaultdict(collections.deque)
+        self.events = collections.deque(maxlen=max_events)
+        self.viewers = set()
+
+    def update(self, status):
+        "Records a manager snapshot, returning the messages for viewers"
+        time = arrow.get(status["time"])
+        previous = self.managers.get(status["manager_id"], {}).get("runs", {})
+        self.managers[status["manager_id"]] = status
+
+        for run_id, run in status["runs"].items():
+            history = self.history[run_id]
+            history.append((time.timestamp(), run["completed"]))
+            while history and history[-1][0] - history[0][0] > self.window:
+                history.popleft()
+
+        messages = [dict(type="status", manager_id=status["manager_id"], runs=self.get_runs(status["manager_id"]))]
+        for run_id in set(previous) - set(status["runs"]):
+            self.history.pop(run_id, None)
+            messages.append(dict(type="finished", manager_id=status["manager_id"], run_id=run_id, time=status["time"]))
+
+        for stall in status["stalled"]:
+            event = dict(type="stall", manager_id=status["manager_id"], time=status["time"], **stall)
+            self.events.append(event)
+            messages.append(event)
+
+        return messages
+
+    def throughput(self, run_id):
+        "Points completed per minute over the window"
+        history = self.history.get(run_id)
+        if not history or len(history) < 2 or history[-1][0] == history[0][0]:
+            return 0.0
+        return 60 * (history[-1][1] - history[0][1]) / (history[-1][0] - history[0][0])
+
+    def get_runs(self, manager_id=None):
+        "Returns the progress of the active runs, of one manager or all of them"
+        now = arrow.utcnow()
+        runs = {}
+        for status in self.managers.values():
+            if manager_id is not None and status["manager_id"] != manager_id:
+                continue
+            if (now - arrow.get(status["time"])).total_seconds() > self.stale:
+                continue
+
+            instances = {instance: dict(check_in, age=(now - arrow.get(check_in["time"])).total_seconds())
+                         for instance, check_in in status["instances"].items()}
+            for run_id, run in status["runs"].items():
+                throughput = self.throughput(run_id)
+                remaining = run["total"] - run["completed"] - run.get("failed", 0)
+                runs[run_id] = dict(run, manager_id=status["manager_id"], throughput=throughput,
+                                    eta=remaining / throughput if throughput > 0 else None, instances=instances)
+
+        return runs
+
+    def publish(self, messages):
+        "Sends messages to every viewer, dropping the oldest messages of viewers that fall behind"
+        for queue in self.viewers:
+            for message in messages:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(message)
+
+    async def listen(self, rcache):
+        "Loads the latest snapshots, then applies new snapshots as managers publish them"
+        pubsub = rcache.pubsub()
+        await pubsub.subscribe(CHANNEL)
+        for status in (await rcache.hgetall(CHANNEL)).values():
+            self.update(json.loads(status))
+
+        while True:
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=60)
+            if message is None:
+                continue
+            try:
+                self.publish(self.update(json.loads(message["data"])))
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Ignoring malformed status message: {e}")
+
+    async def handle(self, reader, writer):
+        "Serves one HTTP request"
+        try:
+            request = (await reader.readline()).decode().split()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request[1].split("?")[0] if len(request) > 1 else ""
+
+            if path in ("/", "/runs"):
+                body = json.dumps(dict(time=str(arrow.utcnow()), runs=self.get_runs(), events=list(self.events))).encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                             + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            elif path == "/events":
+                await self.stream(writer)
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def stream(self, writer):
+        "Streams the current state and then every update to a viewer as server-sent events"
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n")
+        queue = asyncio.Queue(maxsize=1000)
+        queue.put_nowait(dict(type="status", runs=self.get_runs()))
+        self.viewers.add(queue)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=15)
+                    writer.write(f"event: {message['type']}\ndata: {json.dumps(message)}\n\n".encode())
+                except asyncio.TimeoutError:
+                    writer.write(b": keep-alive\n\n")
+                await writer.drain()
+        finally:
+            self.viewers.discard(queue)
+
+
+async def serve(redis_endpoint, redis_port=6379, host="127.0.0.1", port=8080):
+    """Runs the monitor until it is cancelled
+
+    Parameters
+    ----------
+    redis_endpoint : string
+        Endpoint of the redis server that the managers use
+
+    redis_port : int, optional
+        Port of the redis server (Default: 6379)
+
+    host, port : string, int, optional
+        Address to serve viewers on (Default: 127.0.0.1:8080)
+    """
+    monitor = Monitor()
+    rcache = redis.asyncio.Redis(host=redis_endpoint, port=redis_port, db=0)
+    server = await asyncio.start_server(monitor.handle, host, port)
+    logging.info(f"Monitoring runs on {redis_endpoint}:{redis_port}, serving on http://{host}:{port}")
+    try:
+        await monitor.listen(rcache)
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@click.command()
+@click.option("--redis-endpoint", required=True, help="Endpoint of the redis server that the managers use")
+@click.option("--redis-port", default=6379, show_default=True, help="Port of the redis server")
+@click.option("--host", default="127.0.0.1", show_default=True, help="Address to serve viewers on")
+@click.option("--port", default=8080, show_default=True, help="Port to serve viewers on")
+def main(redis_endpoint, redis_port, host, port):
+    "Serves live throughput, ETA, instance utilization and stall events of all active runs"
+    logging.basicConfig(level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(serve(redis_endpoint, redis_port, host, port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
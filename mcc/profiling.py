@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Sampling profiles of entry points and phase timings of the manager
+
+A fraction of the points of a run can be sampled with py-spy, which attaches to the entry point process without
+instrumenting it. Samples are kept as collapsed stacks, one "frame;frame;frame count" line per stack, which
+flamegraph.pl, speedscope and inferno read directly. Workers merge the stacks of their points, and the manager
+merges those of its workers with the timings of its own loop phases.
+
+This module has no dependencies on the rest of mcc so that it can be uploaded next to the worker scripts.
+"""
+import collections
+import contextlib
+import json
+import shutil
+import time
+
+
+class PhaseTimer:
+    "Accumulates the wall time and number of calls of named phases"
+    def __init__(self):
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Times the body of a with statement as one call of a phase"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds, calls = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (seconds + time.perf_counter() - start, calls + 1)
+
+    def as_dict(self):
+        "Returns the total seconds and calls of each phase"
+        return {name: dict(seconds=seconds, calls=calls) for name, (seconds, calls) in self.phases.items()}
+
+
+def profiler_command(pid, path, rate=100):
+    """Returns the command that samples a running process into a collapsed stacks file, or None if py-spy is not
+    installed"""
+    py_spy = shutil.which("py-spy") or shutil.which("/opt/anaconda/bin/py-spy")
+    if py_spy is None:
+        return None
+
+    return [py_spy, "record", "--pid", str(pid), "--rate", str(rate), "--format", "raw", "--nonblocking",
+            "--subprocesses", "--output", path]
+
+
+def read_folded(path):
+    "Reads a collapsed stacks file into a Counter of samples by stack"
+    stacks = collections.Counter()
+    with open(path, "r") as f:
+        for line in f:
+            stack, _, count = line.rstrip("\n").rpartition(" ")
+            if stack and count.isdigit():
+                stacks[stack] += int(count)
+
+    return stacks
+
+
+def write_folded(stacks, path):
+    "Writes a Counter of samples by stack as a collapsed stacks file"
+    with open(path, "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write(f"{stack} {count}\n")
+
+
+def merge_phases(*phases):
+    "Sums the seconds and calls of phase timings"
+    merged = {}
+    for timings in phases:
+        for name, timing in timings.items():
+            total = merged.setdefault(name, dict(seconds=0.0, calls=0))
+            total["seconds"] += timing["seconds"]
+            total["calls"] += timing["calls"]
+
+    return merged
+
+
+def merge_profiles(profiles):
+    """Merges profiles
+
+    Parameters
+    ----------
+    profiles : list{dict}
+        Profiles with "stacks", a Counter of samples by stack, "points", the wall time in seconds and number of
+        samples of each profiled point, and optionally "phases", the timings of manager phases
+
+    Returns
+    -------
+    profile : dict
+        Profile with the samples, points and phase timings of all profiles
+    """
+    merged = dict(stacks=collections.Counter(), points=[], phases={})
+    for profile in profiles:
+        merged["stacks"].update(profile.get("stacks", {}))
+        merged["points"].extend(profile.get("points", []))
+        merged["phases"] = merge_phases(merged["phases"], profile.get("phases", {}))
+
+    return merged
+
+
+def write_profile(profile, path):
+    "Writes a profile as a collapsed stacks file at `{path}.folded` and its point and phase timings at `{path}.json`"
+    write_folded(profile["stacks"], f"{path}.folded")
+    with open(f"{path}.json", "w") as f:
+        json.dump({key: value for key, value in profile.items() if key != "stacks"}, f)
+
+    return [f"{path}.folded", f"{path}.json"]
+
+
+def read_profile(path):
+    "Reads a profile written by `write_profile`"
+    with open(f"{path}.json", "r") as f:
+        profile = json.load(f)
+    profile["stacks"] = read_folded(f"{path}.folded")
+    return profile
+
+
+def self_time(stacks, n=20):
+    """Returns the frames with the most samples at the top of the stack
+
+    Returns
+    -------
+    frames : list{tuple}
+        Frame, samples and fraction of all samples of the `n` frames with the most samples
+    """
+    frames = collections.Counter()
+    for stack, count in stacks.items():
+        frames[stack.rsplit(";", 1)[-1]] += count
+
+    total = sum(frames.values()) or 1
+    return [(frame, count, count / total) for frame, count in frames.most_common(n)]
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Client-side sharding of the redis coordination of runs
+
+A redis topology is a list of [address, port] of independent redis servers, or shards. The first shard, the home
+shard, holds the coordination keys of managers and runs: submissions, check-ins, run specifications, totals and
+the warm pool. The queue partitions of every run are spread over all shards, together with the points in progress
+and the completed and active counts of the points taken from them, so that per-point traffic is divided between
+the shards. Each worker claims from its affinity shard first, and steals from the other shards in turn once its
+own is empty.
+
+This module has no dependencies on the rest of mcc so that it can be uploaded next to the worker scripts.
+"""
+import zlib
+
+import redis
+
+
+def _parse_shard(shard, port):
+    "Normalizes one endpoint to [address, port]"
+    if isinstance(shard, dict):
+        return [shard["Address"], int(shard.get("Port", port))]
+    if isinstance(shard, (list, tuple)):
+        return [shard[0], int(shard[1])]
+
+    address, _, shard_port = str(shard).partition(":")
+    return [address, int(shard_port or port)]
+
+
+def parse_topology(endpoint, port=6379):
+    """Normalizes a redis endpoint, or a list of shard endpoints, into a topology
+
+    Parameters
+    ----------
+    endpoint : string, dict or list
+        Address, "address:port", ElastiCache endpoint dict or [address, port] of a single server, or a list of these
+        for each shard, home shard first
+
+    port : int, optional
+        Port of endpoints without one (Default: 6379)
+
+    Returns
+    -------
+    topology : list{list}
+        [address, port] of each shard
+    """
+    if isinstance(endpoint, (list, tuple)) and not (len(endpoint) == 2 and isinstance(endpoint[1], int)):
+        return [_parse_shard(shard, port) for shard in endpoint]
+
+    return [_parse_shard(endpoint, port)]
+
+
+class Shards:
+    "Clients of every shard of a topology"
+    def __init__(self, topology):
+        self.topology = [list(shard) for shard in topology]
+        self.clients = [redis.Redis(host=address, port=port, db=0) for address, port in self.topology]
+        self.home = self.clients[0]
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __getitem__(self, index):
+        return self.clients[index]
+
+    def __iter__(self):
+        return iter(self.clients)
+
+    def affinity(self, instance_id):
+        "Index of the shard an instance claims from first"
+        return zlib.crc32(instance_id.encode()) % len(self.clients)
+
+    def order(self, start):
+        "Indices of every shard, starting from `start`"
+        return [(start + i) % len(self.clients) for i in range(len(self.clients))]
+
+    def gather(self, commands):
+        """Queues the same commands on a pipeline of every shard, returning the results of each shard
+
+        Parameters
+        ----------
+        commands : callable
+            Called with the pipeline of each shard
+        """
+        results = []
+        for client in self.clients:
+            with client.pipeline(transaction=False) as pipe:
+                commands(pipe)
+                results.append(pipe.execute())
+
+        return results
@@ -8,8 +8,9 @@ sh Miniconda3-latest-Linux-x86_64.sh -b -p /opt/anaconda
 export PATH="/opt/anaconda/bin:$PATH"
 
 source /opt/anaconda/bin/activate
-conda install -y -q python={py_ver} boto3 botocore redis-py arrow psutil
+conda install -y -q python={py_ver} boto3 botocore redis-py arrow psutil msgpack-python zstandard
 conda install -y -q {py_reqs}
+pip install -q py-spy
 
 aws configure set aws_access_key_id {aws_access_key}
 aws configure set aws_secret_access_key {aws_secret_key}
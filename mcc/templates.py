@@ -1,11 +1,39 @@
 # -*- coding: utf-8 -*-
 """Create and Manage Launch Templates"""
+import hashlib
+import json
+import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import boto3
 import botocore
 
+FINGERPRINT_TAG = "mcc-fingerprint"
+
+PY_VERSION = "3.7"
+
+
+def wait_with_backoff(check, delay=5, max_delay=60, backoff=1.5, timeout=3600):
+    "Calls `check` until it returns a truthy value, backing off exponentially between attempts"
+    start = time.monotonic()
+    result = check()
+    while not result:
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"Condition not met after {timeout} seconds")
+        time.sleep(delay)
+        delay = min(delay * backoff, max_delay)
+        result = check()
+
+    return result
+
+
+def userdata_complete(instance_id, ec2=boto3.resource("ec2")):
+    "Checks whether the UserData script on an instance has tagged itself as complete"
+    instance_details = ec2.meta.client.describe_instances(InstanceIds=[instance_id])["Reservations"][0]["Instances"][0]
+    return any(tag["Key"] == "UserData" and tag["Value"] == "complete" for tag in instance_details.get("Tags", []))
+
 
 def create_security_group(security_groups=None, ips=None, ports=None, rules=None, ec2=boto3.resource("ec2")):
     "Create Security Group"
@@ -68,7 +96,7 @@ def build_template_userdata(access_key, secret_key, region):
         with open("requirements.txt", "r") as f:
             py_reqs = " ".join(f.read().split("\n"))
 
-        template_options = {r"{py_ver}": "3.7",
+        template_options = {r"{py_ver}": PY_VERSION,
                             r"{py_reqs}": py_reqs,
                             r"{aws_access_key}": access_key,
                             r"{aws_secret_key}": secret_key,
@@ -80,63 +108,150 @@ def build_template_userdata(access_key, secret_key, region):
     return launch_script
 
 
-def create_custom_image(security_group_id, keyname, launch_script="", default_ami="ami-0ff8a91507f77f867", instance_type="t2.micro", ec2=boto3.resource("ec2")):
-    "Creates custom ec2 ami"
-    launch_options = {"ImageId": default_ami, "SecurityGroupIds": [security_group_id], "UserData": launch_script,
-                      "MinCount": 1, "MaxCount": 1, "KeyName": keyname, "InstanceType": instance_type,
-                      "InstanceInitiatedShutdownBehavior": "stop"}
+def get_environment_fingerprint(template="template_script.sh", requirements="requirements.txt", region=None, default_ami=""):
+    """Fingerprints the environment a custom image is built from
 
-    base_instance = ec2.create_instances(**launch_options)[0]
-    base_instance.wait_until_running()
+    The unrendered template script is fingerprinted rather than the UserData built from it, so that the AWS keys
+    rendered into the UserData never reach the fingerprint, which is stored in tags.
 
-    userdata_running = True
-    while userdata_running:
-        instance_details = ec2.meta.client.describe_instances(InstanceIds=[base_instance.id])["Reservations"][0]["Instances"][0]
-        for tag in instance_details.get("Tags", []):
-            if tag["Key"] == "UserData" and tag["Value"] == "complete":
-                userdata_running = False
-        time.sleep(5)
+    Parameters
+    ----------
+    template : string, optional
+        Path to the template script, see `build_template_userdata` (Default: "template_script.sh")
 
-    try:
-        response = ec2.meta.client.create_image(InstanceId=base_instance.id, Name="default_ami", Description="default custom image")
-        custom_ami_id = response["ImageId"]
+    requirements : string, optional
+        Path to the python requirements file (Default: "requirements.txt")
+
+    region : string, optional
+        Region the custom image is built in (Default: the region of the default boto3 session)
+
+    default_ami : string, optional
+        Base image the custom image is built from
+
+    Returns
+    -------
+    fingerprint : string
+        Hex digest that only changes when the environment changes
+    """
+    if region is None:
+        region = boto3.session.Session().region_name or ""
+
+    digest = hashlib.sha256(f"{PY_VERSION}\n{region}\n{default_ami}\n".encode())
+    if template and os.path.exists(template):
+        with open(template, "r") as f:
+            digest.update(f.read().encode())
+    if requirements and os.path.exists(requirements):
+        with open(requirements, "r") as f:
+            digest.update("\n".join(sorted(line.strip() for line in f if line.strip())).encode())
+
+    return digest.hexdigest()[:32]
+
+
+def find_custom_image(fingerprint, ec2=boto3.resource("ec2")):
+    "Returns the id of an available or pending custom ami tagged with fingerprint, or None"
+    filters = [{"Name": f"tag:{FINGERPRINT_TAG}", "Values": [fingerprint]}, {"Name": "state", "Values": ["available", "pending"]}]
+    images = ec2.meta.client.describe_images(Owners=["self"], Filters=filters)["Images"]
+    if not images:
+        return None
+
+    images.sort(key=lambda image: (image["State"] == "available", image["CreationDate"]))
+    return images[-1]["ImageId"]
+
+
+def create_custom_image(security_group_id, keyname, launch_script="", default_ami="ami-0ff8a91507f77f867", instance_type="t2.micro",
+                        fingerprint=None, ec2=boto3.resource("ec2")):
+    "Creates custom ec2 ami, reusing an existing one if the environment fingerprint matches"
+    if fingerprint is None:
+        fingerprint = get_environment_fingerprint(default_ami=default_ami)
 
-        ami_status = ec2.meta.client.describe_images(ImageIds=[custom_ami_id])["Images"][0]["State"]
-        while ami_status == "pending":
-            time.sleep(5)
-            ami_status = ec2.meta.client.describe_images(ImageIds=[custom_ami_id])["Images"][0]["State"]
+    base_instance = None
+    custom_ami_id = find_custom_image(fingerprint, ec2=ec2)
+    if custom_ami_id is not None:
+        logging.info(f"Reusing custom AMI {custom_ami_id} with fingerprint {fingerprint}")
 
-        if ami_status == "available":
+    try:
+        if custom_ami_id is None:
+            launch_options = {"ImageId": default_ami, "SecurityGroupIds": [security_group_id], "UserData": launch_script,
+                              "MinCount": 1, "MaxCount": 1, "KeyName": keyname, "InstanceType": instance_type,
+                              "InstanceInitiatedShutdownBehavior": "stop"}
+
+            base_instance = ec2.create_instances(**launch_options)[0]
+            base_instance.wait_until_running()
+
+            wait_with_backoff(lambda: userdata_complete(base_instance.id, ec2=ec2), delay=15)
+
+            name = f"mcc-{fingerprint}"
+            try:
+                response = ec2.meta.client.create_image(InstanceId=base_instance.id, Name=name, Description=f"mcc custom image {fingerprint}",
+                                                        TagSpecifications=[{"ResourceType": "image", "Tags": [{"Key": FINGERPRINT_TAG, "Value": fingerprint}]}])
+                custom_ami_id = response["ImageId"]
+            except botocore.exceptions.ClientError as e:
+                if e.response["Error"]["Code"] == "InvalidAMIName.Duplicate":
+                    custom_ami_id = ec2.meta.client.describe_images(Owners=["self"], Filters=[{"Name": "name", "Values": [name]}])["Images"][0]["ImageId"]
+                else:
+                    raise e
+
+        try:
+            ec2.meta.client.get_waiter("image_available").wait(ImageIds=[custom_ami_id], WaiterConfig={"Delay": 15, "MaxAttempts": 240})
+        except botocore.exceptions.WaiterError as e:
+            raise Exception(f"Creation of AMI {custom_ami_id} failed") from e
+    finally:
+        if base_instance is not None:
             base_instance.terminate()
-        elif ami_status == "failed":
-            raise Exception("Creation of AMI failed")
-        else:
-            print(f"Warning: AMI {custom_ami_id} has status {ami_status}")
-    except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "InvalidAMIName.Duplicate":
-            pass
-        else:
-            raise e
 
     return custom_ami_id
 
 
-def create_launch_template(custom_ami_id, security_group_id, ec2=boto3.resource("ec2")):
-    "Creates launch template"
+def find_launch_template(name, ec2=boto3.resource("ec2")):
+    "Returns the id of the launch template with the given name, or None"
+    templates = ec2.meta.client.describe_launch_templates(Filters=[{"Name": "launch-template-name", "Values": [name]}])["LaunchTemplates"]
+    if not templates:
+        return None
+
+    return templates[0]["LaunchTemplateId"]
+
+
+def create_launch_template(custom_ami_id, security_group_id, keyname="aws_default_key", fingerprint=None, ec2=boto3.resource("ec2")):
+    """Creates launch template, reusing an existing one built from the same fingerprint, image, security group and key pair
+
+    The environment fingerprint is stored in the "mcc-fingerprint" tag of the template"""
+    template_data = dict(ImageId=custom_ami_id, SecurityGroupIds=[security_group_id], KeyName=keyname)
+    if fingerprint is None:
+        tags = ec2.meta.client.describe_images(ImageIds=[custom_ami_id])["Images"][0].get("Tags", [])
+        fingerprint = next((tag["Value"] for tag in tags if tag["Key"] == FINGERPRINT_TAG), custom_ami_id)
+
+    name = "mcc-template-" + hashlib.sha256(f"{fingerprint}{json.dumps(template_data, sort_keys=True)}".encode()).hexdigest()[:32]
+
+    template_id = find_launch_template(name, ec2=ec2)
+    if template_id is not None:
+        logging.info(f"Reusing launch template {template_id} with fingerprint {fingerprint}")
+        return template_id
+
     try:
-        response = ec2.meta.client.create_launch_template(LaunchTemplateName="default_template", LaunchTemplateData=dict(ImageId=custom_ami_id, SecurityGroupIds=[security_group_id], KeyName="aws_default_key"))
+        response = ec2.meta.client.create_launch_template(LaunchTemplateName=name, LaunchTemplateData=template_data,
+                                                          TagSpecifications=[{"ResourceType": "launch-template",
+                                                                              "Tags": [{"Key": FINGERPRINT_TAG, "Value": fingerprint}]}])
         template_id = response["LaunchTemplate"]["LaunchTemplateId"]
     except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] == "InvalidLaunchTemplateName.AlreadyExistsException":
-            pass
+            template_id = find_launch_template(name, ec2=ec2)
         else:
             raise e
 
     return template_id
 
 
-def create_redis_server(security_group_id, name="redis-default-cache", nodes=1, instance_type="cache.t2.micro", port=6379, redis_client=boto3.client("elasticache")):
-    "Creates a ElastiCache Redis Server"
+def create_redis_server(security_group_id, name="redis-default-cache", nodes=1, instance_type="cache.t2.micro", port=6379,
+                        shards=1, replicas=0, redis_client=boto3.client("elasticache")):
+    """Creates a ElastiCache Redis Server
+
+    With several `shards`, or with `replicas`, creates one replication group per shard, named "{name}-{i}", each with
+    a primary and `replicas` read replicas that it fails over to. The endpoint is then the list of the primary
+    endpoint of each shard, which `mcc.launch.launch_manager` accepts as `redis_endpoint`.
+    """
+    if shards > 1 or replicas:
+        return create_redis_shards(security_group_id, name, shards, replicas, instance_type, port, redis_client)
+
     try:
         response = redis_client.create_cache_cluster(CacheClusterId=name,
                                                      AZMode="single-az",
@@ -146,11 +261,8 @@ def create_redis_server(security_group_id, name="redis-default-cache", nodes=1,
                                                      SecurityGroupIds=[security_group_id],
                                                      Port=port)
 
-        status = response["CacheCluster"]["CacheClusterStatus"]
-        while status != "available":
-            time.sleep(5)
-            response = redis_client.describe_cache_clusters(CacheClusterId=name, ShowCacheNodeInfo=True)
-            status = response["CacheClusters"][0]["CacheClusterStatus"]
+        if response["CacheCluster"]["CacheClusterStatus"] != "available":
+            redis_client.get_waiter("cache_cluster_available").wait(CacheClusterId=name, WaiterConfig={"Delay": 15, "MaxAttempts": 120})
     except botocore.exceptions.ClientError as e:
         if e.response["Error"]["Code"] != "CacheClusterAlreadyExists":
             raise e
@@ -159,3 +271,163 @@ def create_redis_server(security_group_id, name="redis-default-cache", nodes=1,
     endpoint = response["CacheClusters"][0]["CacheNodes"][0]["EndPoint"]
 
     return name, endpoint, port
+
+
+def create_redis_shards(security_group_id, name, shards, replicas, instance_type, port, redis_client):
+    "Creates a replication group for each shard, returning their ids, their primary endpoints and the port"
+    group_ids = [f"{name}-{i}" for i in range(shards)]
+    for group_id in group_ids:
+        try:
+            redis_client.create_replication_group(ReplicationGroupId=group_id,
+                                                  ReplicationGroupDescription=f"mcc shard of {name}",
+                                                  NumCacheClusters=1 + replicas,
+                                                  AutomaticFailoverEnabled=bool(replicas),
+                                                  MultiAZEnabled=bool(replicas),
+                                                  CacheNodeType=instance_type,
+                                                  Engine="redis",
+                                                  SecurityGroupIds=[security_group_id],
+                                                  Port=port)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] != "ReplicationGroupAlreadyExistsFault":
+                raise e
+
+    endpoints = []
+    for group_id in group_ids:
+        redis_client.get_waiter("replication_group_available").wait(ReplicationGroupId=group_id,
+                                                                    WaiterConfig={"Delay": 15, "MaxAttempts": 120})
+        response = redis_client.describe_replication_groups(ReplicationGroupId=group_id)
+        endpoint = response["ReplicationGroups"][0]["NodeGroups"][0]["PrimaryEndpoint"]
+        endpoints.append([endpoint["Address"], endpoint["Port"]])
+
+    return group_ids, endpoints, port
+
+
+def run_steps(steps, max_workers=4):
+    """Runs a dependency graph of provisioning steps, running independent steps concurrently
+
+    Parameters
+    ----------
+    steps : dict
+        Mapping of step name to a tuple of (dependencies, function). Each function is called
+        with the results of its dependencies as keyword arguments, once they have all completed.
+
+    max_workers : int, optional
+        Maximum number of steps to run at once (Default: 4)
+
+    Returns
+    -------
+    results : dict
+        Result of each step, by name
+
+    timings : dict
+        Wall clock time of each step in seconds, by name
+    """
+    for name, (deps, func) in steps.items():
+        missing = [dep for dep in deps if dep not in steps]
+        if missing:
+            raise ValueError(f"Step '{name}' depends on unknown steps {missing}")
+
+    results, timings, running = {}, {}, {}
+
+    def timed(name, func, kwargs):
+        start = time.monotonic()
+        logging.info(f"Provisioning step '{name}' started")
+        result = func(**kwargs)
+        timings[name] = time.monotonic() - start
+        logging.info(f"Provisioning step '{name}' finished in {timings[name]:.1f}s")
+        return result
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = dict(steps)
+        while pending or running:
+            for name, (deps, func) in list(pending.items()):
+                if all(dep in results for dep in deps):
+                    running[executor.submit(timed, name, func, {dep: results[dep] for dep in deps})] = name
+                    del pending[name]
+
+            if not running:
+                raise ValueError(f"Provisioning steps {list(pending)} have circular dependencies")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    return results, timings
+
+
+def provision(ips=None, ports=None, security_groups=None, keyname="aws_default_key", launch_script="",
+              default_ami="ami-0ff8a91507f77f867", image_instance_type="t2.micro", redis_options=None, max_workers=4,
+              fingerprint=None):
+    """Creates all infrastructure required for a run
+
+    The custom image and the redis server are built concurrently, since together they account for most of the
+    provisioning time. The custom image and launch template are reused when the environment fingerprint matches.
+    Each step uses its own boto3 session, as sessions are not thread-safe.
+
+    Parameters
+    ----------
+    ips, ports, security_groups : dict, optional
+        Ingress rules, see `create_security_group`
+
+    keyname : string, optional
+        Name of the key pair (Default: "aws_default_key")
+
+    launch_script : string, optional
+        UserData script used to build the custom image, see `build_template_userdata`
+
+    default_ami : string, optional
+        Base image to build the custom image from
+
+    image_instance_type : string, optional
+        Instance type used to build the custom image (Default: "t2.micro")
+
+    redis_options : dict, optional
+        Additional keyword arguments to `create_redis_server`
+
+    max_workers : int, optional
+        Maximum number of steps to run at once (Default: 4)
+
+    fingerprint : string, optional
+        Environment fingerprint of the custom image (Default: the fingerprint of "template_script.sh" and
+        "requirements.txt", see `get_environment_fingerprint`)
+
+    Returns
+    -------
+    infrastructure : dict
+        security_group_id, keyname, custom_ami_id, template_id, redis_id, redis_endpoint, redis_port and
+        the per-step timings in seconds
+    """
+    if redis_options is None:
+        redis_options = {}
+
+    if fingerprint is None:
+        fingerprint = get_environment_fingerprint(default_ami=default_ami)
+
+    def ec2():
+        return boto3.session.Session().resource("ec2")
+
+    steps = {
+        "security_group": ((), lambda: create_security_group(security_groups=security_groups, ips=ips, ports=ports, ec2=ec2())),
+        "key_pair": ((), lambda: create_key_pair(keyname=keyname, ec2=ec2())),
+        "custom_image": (("security_group", "key_pair"),
+                         lambda security_group, key_pair: create_custom_image(security_group, key_pair, launch_script=launch_script,
+                                                                              default_ami=default_ami, instance_type=image_instance_type,
+                                                                              fingerprint=fingerprint, ec2=ec2())),
+        "launch_template": (("custom_image", "security_group", "key_pair"),
+                            lambda custom_image, security_group, key_pair: create_launch_template(custom_image, security_group,
+                                                                                                  keyname=key_pair, fingerprint=fingerprint,
+                                                                                                  ec2=ec2())),
+        "redis_server": (("security_group",),
+                         lambda security_group: create_redis_server(security_group, redis_client=boto3.session.Session().client("elasticache"),
+                                                                    **redis_options)),
+    }
+
+    results, timings = run_steps(steps, max_workers=max_workers)
+
+    logging.info("Provisioning timings: " + ", ".join(f"{name}={seconds:.1f}s" for name, seconds in timings.items()))
+
+    redis_id, redis_endpoint, redis_port = results["redis_server"]
+
+    return dict(security_group_id=results["security_group"], keyname=results["key_pair"], custom_ami_id=results["custom_image"],
+                template_id=results["launch_template"], redis_id=redis_id, redis_endpoint=redis_endpoint, redis_port=redis_port,
+                timings=timings)
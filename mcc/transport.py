@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Compressed transport of results and logs to and from S3
+
+Files are compressed while they are streamed to S3, and decompressed while they are read back, so neither side
+stages a full uncompressed copy on disk. The compression of an object is recorded in its extension.
+
+This module has no dependencies on the rest of mcc so that it can be uploaded next to the worker scripts.
+"""
+import gzip
+import io
+import shutil
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+CHUNK_SIZE = 8 * 1024 ** 2
+
+
+class CompressingReader(io.RawIOBase):
+    "Readable stream of the compressed contents of another readable stream"
+    def __init__(self, fileobj, compressor):
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.buffer = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) < len(b) and not self.eof:
+            chunk = self.fileobj.read(CHUNK_SIZE)
+            if chunk:
+                self.buffer += self.compressor.compress(chunk)
+            else:
+                self.buffer += self.compressor.flush()
+                self.eof = True
+
+        size = min(len(b), len(self.buffer))
+        b[:size] = self.buffer[:size]
+        del self.buffer[:size]
+        return size
+
+
+class RawReader(io.RawIOBase):
+    "Adapts any object with a `read` method, such as an S3 streaming body, to a raw binary stream"
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.fileobj.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.fileobj.close()
+        super().close()
+
+
+def as_text(stream):
+    "Wraps a binary stream for reading text"
+    if not isinstance(stream, io.BufferedIOBase):
+        stream = io.BufferedReader(stream if isinstance(stream, io.RawIOBase) else RawReader(stream), CHUNK_SIZE)
+    return io.TextIOWrapper(stream)
+
+
+class MultipartWriter(io.RawIOBase):
+    """Writable stream that uploads to S3 in parts as it is written, compressing it on the fly
+
+    At most one part is held in memory at once. The upload is completed when the stream is closed, or aborted
+    if it is closed while handling an exception.
+    """
+    def __init__(self, client, bucket, key, compression=None, part_size=CHUNK_SIZE):
+        self.client = client
+        self.bucket = bucket
+        self.compression = resolve_compression(compression)
+        self.key = key if self.compression is None else f"{key}{EXTENSIONS[self.compression]}"
+        self.compressor = None if self.compression is None else get_compressor(self.compression)
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = client.create_multipart_upload(Bucket=bucket, Key=self.key)["UploadId"]
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.buffer += self.compressor.compress(bytes(b)) if self.compressor is not None else b
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return len(b)
+
+    def upload_part(self):
+        "Uploads the buffered data as the next part"
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=len(self.parts) + 1, Body=bytes(self.buffer))
+        self.parts.append({"ETag": response["ETag"], "PartNumber": len(self.parts) + 1})
+        self.buffer = bytearray()
+
+    def abort(self):
+        "Aborts the upload"
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        super().close()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush()
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": self.parts})
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def resolve_compression(compression):
+    "Returns the compression that will be used, falling back to gzip if zstandard is not installed"
+    if compression not in (None, "gzip", "zstd"):
+        raise ValueError(f"Unknown compression '{compression}', expected 'gzip', 'zstd' or None")
+    if compression == "zstd" and zstandard is None:
+        return "gzip"
+    return compression
+
+
+def get_compressor(compression):
+    "Returns a streaming compressor with `compress` and `flush` methods"
+    if compression == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def strip_extension(name):
+    "Removes the compression extension, if any, from a file name or key"
+    for extension in EXTENSIONS.values():
+        if name.endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def is_compressed(name):
+    "Checks whether a file name or key has a compression extension"
+    return strip_extension(name) != name
+
+
+def upload_file(client, path, bucket, key, compression=None):
+    """Uploads a file to S3, compressing it while it is streamed
+
+    Parameters
+    ----------
+    client : s3 client
+        S3 client object
+
+    path : string
+        Local path of the file
+
+    bucket : string
+        Name of bucket
+
+    key : string
+        Key of the uploaded object, without a compression extension
+
+    compression : string, optional
+        "gzip", "zstd" or None (Default: None, uploads uncompressed)
+
+    Returns
+    -------
+    key : string
+        Key of the uploaded object, including the compression extension
+    """
+    compression = resolve_compression(compression)
+    if compression is None:
+        client.upload_file(path, bucket, key)
+        return key
+
+    key = f"{key}{EXTENSIONS[compression]}"
+    with open(path, "rb") as f:
+        client.upload_fileobj(CompressingReader(f, get_compressor(compression)), bucket, key)
+
+    return key
+
+
+def decompress_stream(fileobj, name):
+    "Wraps a readable binary stream so that it is decompressed on the fly, based on the extension of name"
+    if name.endswith(EXTENSIONS["gzip"]):
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if name.endswith(EXTENSIONS["zstd"]):
+        if zstandard is None:
+            raise RuntimeError(f"'{name}' is zstd compressed, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def open_file(path, mode="rb"):
+    """Opens a local file for reading, decompressing it on the fly if it has a compression extension
+
+    Parameters
+    ----------
+    path : string
+        Local path of the file
+
+    mode : string, optional
+        "rb" or "r" (Default: "rb")
+
+    Returns
+    -------
+    f : file object
+        Binary or text stream of the uncompressed contents
+    """
+    if path.endswith(EXTENSIONS["gzip"]):
+        stream = gzip.open(path, "rb")
+    else:
+        stream = decompress_stream(open(path, "rb"), path)
+    return stream if "b" in mode else as_text(stream)
+
+
+def open_object(client, bucket, key, mode="rb"):
+    "Opens an S3 object for streaming reads, decompressing it on the fly if it has a compression extension"
+    stream = decompress_stream(client.get_object(Bucket=bucket, Key=key)["Body"], key)
+    return stream if "b" in mode else as_text(stream)
+
+
+def decompress_file(path):
+    """Decompresses a local file next to itself, streaming it through a buffer of `CHUNK_SIZE`
+
+    Returns
+    -------
+    path : string
+        Path of the decompressed file, which is the path given if it is not compressed
+    """
+    if not is_compressed(path):
+        return path
+
+    output = strip_extension(path)
+    with open_file(path, "rb") as f, open(output, "wb") as out:
+        shutil.copyfileobj(f, out, CHUNK_SIZE)
+
+    return output
@@ -1,22 +1,27 @@
 #!/opt/anaconda/bin/python
 """UserData template for workers"""
+import importlib.util
 import json
 import logging
 import os
+import random
+import resource
 import shutil
+import signal
 import subprocess
 import sys
 import time
+from collections import Counter
 from multiprocessing import cpu_count
 from multiprocessing.dummy import Pool
-from threading import Thread
+from threading import Condition, Event, Lock, Thread
 import requests
 
 import arrow
 import boto3
 import psutil
-import redis
 
+sys.path.append("/")
 
 class LoggerWriter:
     def __init__(self, level):
@@ -35,144 +40,514 @@ sys.stdout = LoggerWriter(logger.debug)
 sys.stderr = LoggerWriter(logger.warning)
 
 instance_id = requests.get('http://169.254.169.254/latest/meta-data/instance-id').text
+instance_type = requests.get('http://169.254.169.254/latest/meta-data/instance-type').text
 
-worker_data = json.loads("{{worker_data}}")
+worker_data = json.loads({{worker_data}})
+manager_id = worker_data['manager_instance_id']
+session = 0
 
 s3 = boto3.resource("s3")
-files = [obj.key for obj in s3.Bucket(worker_data['s3_bucket']).objects.all() if obj.key.startswith(f"script/")]
-for file in files:
-    s3.meta.client.download_file(worker_data['s3_bucket'], file, file.replace("script/", ""))
+for file in ["codec", "inputs", "profiling", "shards", "transport"]:
+    s3.meta.client.download_file(worker_data['s3_bucket'], f"script/{file}.py", f"{file}.py")
 
-try:
-    os.mkdir("results")
-except FileExistsError:
-    pass
+from codec import pack_point, split_point, unpack_point
+from inputs import prepare_inputs, write_manifest
+from profiling import profiler_command, read_folded, write_profile
+from shards import Shards
+from transport import upload_file
 
-rcache = redis.Redis(host=worker_data['redis_endpoint'], port=worker_data['redis_port'], db=0)
-with rcache.pipeline() as pipe:
-    while True:
+shards = Shards(worker_data['redis_topology'])
+rcache = shards.home
+affinity = shards.affinity(instance_id)
+
+class ConcurrencyController:
+    """Limits the number of points running at once to what the cpus and memory of the instance allow
+
+    The limit starts at one point per vcpu (per core without hyperthreading) and is adjusted between one and the
+    number of vcpus from cheap samples of cpu use, memory and load. A point only starts when its resource hints,
+    "memory" in MB and "cpus", fit in what is left, or when nothing else is running.
+    """
+    def __init__(self, limit, max_limit, interval=5, memory_reserve=0.1, startup_time=60):
+        self.limit = limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.memory_reserve = memory_reserve * psutil.virtual_memory().total
+        self.startup_time = startup_time
+        self.slots = 0
+        self.running = {}
+        self.condition = Condition()
+        self.sample()
+
+    def sample(self):
+        "Samples cpu use, available memory and load"
+        self.cpu = psutil.cpu_percent(interval=None)
+        self.available = psutil.virtual_memory().available
+        self.load = os.getloadavg()[0] / psutil.cpu_count()
+
+    def free_memory(self):
+        "Available memory, less the hints of points that started too recently to have allocated it"
+        now = time.monotonic()
+        starting = sum(memory for started, memory, _ in self.running.values() if now - started < self.startup_time)
+        return self.available - starting - self.memory_reserve
+
+    def acquire_slot(self):
+        "Waits until fewer points are claimed than the current limit"
+        with self.condition:
+            self.condition.wait_for(lambda: self.slots < self.limit)
+            self.slots += 1
+
+    def release_slot(self):
+        "Releases a slot that did not claim a point"
+        with self.condition:
+            self.slots -= 1
+            self.condition.notify_all()
+
+    def start(self, key, resources):
+        "Waits until the resource hints of a claimed point fit, then records it as running"
+        memory = resources.get("memory", 0) * 1024 ** 2
+        cpus = resources.get("cpus", 1)
+
+        def fits():
+            used_cpus = sum(point_cpus for _, _, point_cpus in self.running.values())
+            return not self.running or (memory <= self.free_memory() and used_cpus + cpus <= psutil.cpu_count())
+
+        with self.condition:
+            self.condition.wait_for(fits)
+            self.running[key] = (time.monotonic(), memory, cpus)
+
+    def finish(self, key):
+        "Records a point as finished and releases its slot"
+        with self.condition:
+            del self.running[key]
+            self.slots -= 1
+            self.condition.notify_all()
+
+    def run(self):
+        "Adjusts the limit from resource samples until the worker is finished"
+        while not finished.wait(self.interval):
+            with self.condition:
+                self.sample()
+                limit = self.limit
+                if self.available < self.memory_reserve or self.cpu > 95.0 or self.load > 1.5:
+                    limit = max(1, self.limit - 1)
+                elif self.slots >= self.limit and self.cpu < 70.0 and self.load < 0.9 and self.free_memory() > 2 * self.memory_reserve:
+                    limit = min(self.max_limit, self.limit + 1)
+
+                if limit != self.limit:
+                    logging.info(f"Concurrency limit {self.limit} -> {limit} ::: CPU @ {self.cpu}%  load {self.load:.2f}  "
+                                 f"available memory {self.available / 1024 ** 2:.0f} MB")
+                    self.limit = limit
+                    self.condition.notify_all()
+
+
+run_dirs = {}
+node_active = {}
+profiles = {}
+uploaded_runs = set()
+runs_lock = Lock()
+upload_lock = Lock()
+finished = Event()
+preparing = set()
+preparation_locks = {}
+
+
+def get_active_runs():
+    "Returns the runs currently hosted by the manager with a worker pool of this instance's type"
+    runs = {run_id.decode(): json.loads(run) for run_id, run in rcache.hgetall(f"{manager_id}_runs").items()}
+    return {run_id: run for run_id, run in runs.items()
+            if any(pool["instance_type"] == instance_type for pool in run["worker_pools"])}
+
+
+def prepare_run(run):
+    """Downloads the scripts of a run from script/{run_id}/ next to the modules its entry point imports, and prepares
+    its shared inputs, once per node
+
+    Slots wait on a lock of the run while it is prepared, so that slots claiming points of other runs are not held up
+    by the download. The instance keeps checking in while it prepares, however idle it is, so that the manager does
+    not take it for stalled."""
+    with runs_lock:
+        if run["run_id"] in run_dirs:
+            return run_dirs[run["run_id"]]
+        lock = preparation_locks.setdefault(run["run_id"], Lock())
+
+    with lock:
+        with runs_lock:
+            if run["run_id"] in run_dirs:
+                return run_dirs[run["run_id"]]
+            preparing.add(run["run_id"])
         try:
-            pipe.watch(f"{worker_data['manager_instance_id']}_in_progress")
-            in_progress = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_in_progress"))
-            in_progress[instance_id] = dict(points=[], check_in=str(arrow.utcnow()))
-            pipe.multi()
-            pipe.set(f"{worker_data['manager_instance_id']}_in_progress", json.dumps(in_progress))
+            run_dir = os.path.abspath(os.path.join("runs", run["run_id"]))
+            for obj in s3.Bucket(run['s3_bucket']).objects.filter(Prefix=f"script/{run['run_id']}/"):
+                path = os.path.join(run_dir, os.path.relpath(obj.key, f"script/{run['run_id']}"))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                s3.meta.client.download_file(run['s3_bucket'], obj.key, path)
+            for module in ["codec.py", "inputs.py"]:
+                shutil.copyfile(module, os.path.join(run_dir, module))
+            if run.get("inputs"):
+                manifest = prepare_inputs(s3.meta.client, run['s3_bucket'], run['inputs'], "cache")
+                write_manifest(manifest, os.path.join(run_dir, "inputs.json"))
+                logging.info(f"Prepared inputs {list(manifest)} of run {run['run_id']}")
+            os.makedirs(os.path.join("output", run["run_id"]), exist_ok=True)
+            with runs_lock:
+                run_dirs[run["run_id"]] = run_dir
+        finally:
+            with runs_lock:
+                preparing.discard(run["run_id"])
+
+    return run_dir
+
+
+def pop_point(run_id, shard):
+    """Moves a point of a run from the 'remaining' partition of this instance's type to its 'in_progress' list,
+    both on the given shard"""
+    with shards[shard].pipeline() as pipe:
+        pipe.rpoplpush(f"{run_id}_remaining_{instance_type}", f"{run_id}_in_progress_{instance_id}")
+        pipe.incr(f"{run_id}_active")
+        point, _ = pipe.execute()
+
+    if point is None:
+        shards[shard].decr(f"{run_id}_active")
+        return None
+
+    with shards[shard].pipeline() as pipe:
+        pipe.sadd(f"{run_id}_workers", instance_id)
+        pipe.srem(f"{run_id}_uploaded", instance_id)
+        pipe.execute()
+
+    return point
+
+
+def claim_point():
+    """Claims a point from the run with the fewest points in progress relative to its share of the workers
+
+    Points are claimed from this instance's affinity shard first, then stolen from the other shards in turn. The
+    points in progress of each run are counted on the affinity shard alone, which the shards share in proportion.
+
+    Returns the run, the queued point and the index of its shard, or `None` for all three if every run is finished.
+    The point and shard are `None` alone if the manager is still queueing points."""
+    runs = get_active_runs()
+    shares = sorted(runs.values(), key=lambda run: int(shards[affinity].get(f"{run['run_id']}_active") or 0) / run.get("share", 1))
+    for run in shares:
+        prepare_run(run)
+        with runs_lock:
+            node_active[run["run_id"]] = node_active.get(run["run_id"], 0) + 1
+        for shard in shards.order(affinity):
+            point = pop_point(run["run_id"], shard)
+            if point is not None:
+                uploaded_runs.discard(run["run_id"])
+                return run, point, shard
+        with runs_lock:
+            node_active[run["run_id"]] -= 1
+
+    if any(not rcache.get(f"{run_id}_exhausted") for run_id in runs):
+        return runs, None, None
+
+    return None, None, None
+
+
+def complete_point(run_id, point, shard):
+    """Moves a point of a run from this instance's 'in_progress' list to the 'completed' count of its shard
+
+    A point that the manager has already returned to the queue, because this instance stalled, is not counted."""
+    if shards[shard].lrem(f"{run_id}_in_progress_{instance_id}", 1, point):
+        with shards[shard].pipeline() as pipe:
+            pipe.incr(f"{run_id}_completed")
+            pipe.decr(f"{run_id}_active")
+            pipe.hdel(f"{run_id}_attempts", point)
             pipe.execute()
+
+    with runs_lock:
+        node_active[run_id] -= 1
+
+
+def fail_point(run, point, values, reason, shard):
+    """Returns a failed point of a run to the queue partition of this instance's type on its shard to be retried, or
+    moves it to the dead-letter list of the run once it has failed `max_retries` times"""
+    run_id = run["run_id"]
+    if shards[shard].lrem(f"{run_id}_in_progress_{instance_id}", 1, point):
+        attempts = shards[shard].hincrby(f"{run_id}_attempts", point, 1)
+
+        with shards[shard].pipeline() as pipe:
+            if attempts <= run.get("max_retries", 2):
+                logging.warning(f"Point {values} of run {run_id} {reason}, retrying ({attempts}/{run.get('max_retries', 2)})")
+                pipe.lpush(f"{run_id}_remaining_{instance_type}", point)
+            else:
+                logging.error(f"Point {values} of run {run_id} {reason}, giving up after {attempts} attempts")
+                rcache.rpush(f"{run_id}_dead", pack_point(dict(point=unpack_point(point), error=reason, attempts=attempts,
+                                                               instance_id=instance_id)))
+                pipe.hdel(f"{run_id}_attempts", point)
+            pipe.decr(f"{run_id}_active")
+            pipe.execute()
+
+    with runs_lock:
+        node_active[run_id] -= 1
+
+
+def run_point(args, point, cwd, timeout=None, memory=None, profile=None, rate=100):
+    """Runs the entry point of a point in its own process group, limited to `timeout` seconds and `memory` MB
+
+    If `profile` is given, the point is sampled `rate` times a second into a collapsed stacks file at that path.
+
+    Returns
+    -------
+    error : string or None
+        Why the point failed, or None if it exited successfully
+    """
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, cwd=cwd, start_new_session=True)
+    except OSError as e:
+        return f"could not be started: {e}"
+    if memory:
+        try:
+            resource.prlimit(process.pid, resource.RLIMIT_AS, (memory * 1024 ** 2, memory * 1024 ** 2))
+        except OSError as e:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            process.communicate()
+            return f"could not be limited to {memory} MB: {e}"
+    profiler = None
+    if profile is not None:
+        command = profiler_command(process.pid, profile, rate)
+        if command is None:
+            logging.warning("py-spy is not installed, points will not be profiled")
+        else:
+            profiler = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        process.communicate(point, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+        return f"timed out after {timeout}s"
+    finally:
+        if profiler is not None:
+            try:
+                profiler.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                profiler.kill()
+
+    if process.returncode < 0:
+        return f"was killed by {signal.Signals(-process.returncode).name}"
+    if process.returncode > 0:
+        return f"exited with code {process.returncode}"
+    return None
+
+
+def record_profile(run_id, path, wall):
+    "Adds the samples of a profiled point to the profile of its run on this instance"
+    if not os.path.exists(path):
+        return
+
+    stacks = read_folded(path)
+    os.remove(path)
+    with runs_lock:
+        profile = profiles.setdefault(run_id, dict(stacks=Counter(), points=[]))
+        profile["stacks"].update(stacks)
+        profile["points"].append(dict(wall=wall, samples=sum(stacks.values())))
+
+
+def load_combine(run_id):
+    "Imports the combine_data module of a run"
+    spec = importlib.util.spec_from_file_location(f"combine_data_{run_id}", os.path.join(run_dirs[run_id], "combine_data.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def upload_results(run_id, run):
+    """Uploads the partial results of a run from this instance
+
+    If the combine hook of the run supports partial merges, the files of all slots are merged into one file
+    per instance first."""
+    files = [os.path.join("output", run_id, file) for file in os.listdir(os.path.join("output", run_id))]
+    combine = load_combine(run_id)
+    if files and getattr(combine, "supports_partial", False):
+        fileout = os.path.join("combined", run_id, f"{instance_id}.{session}{os.path.splitext(combine.output_file)[1]}")
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        combine.combine_data(files, fileout)
+        logging.info(f"Combined {len(files)} slot files of run {run_id}")
+        files = [fileout]
+
+    for file in files:
+        upload_file(s3.meta.client, file, run['s3_bucket'], f"results/{run_id}/{os.path.basename(file)}", run.get('compression'))
+
+    with runs_lock:
+        profile = profiles.get(run_id)
+        if profile is not None:
+            files = write_profile(profile, os.path.join("profiles", run_id, f"{instance_id}_{session}"))
+    if profile is not None:
+        for file in files:
+            s3.meta.client.upload_file(file, run['s3_bucket'], f"results/{run_id}/profiles/{os.path.basename(file)}")
+
+    for client in shards:
+        client.sadd(f"{run_id}_uploaded", instance_id)
+    logging.info(f"Uploaded results of run {run_id}")
+
+
+def upload_finished_runs(force=False):
+    "Uploads the results of runs with no points remaining and none in progress on this instance"
+    with upload_lock:
+        runs = get_active_runs()
+        for run_id in list(run_dirs):
+            if run_id in uploaded_runs or run_id not in runs:
+                continue
+            with runs_lock:
+                active = node_active.get(run_id, 0)
+            finished = rcache.get(f"{run_id}_exhausted") and not any(client.llen(f"{run_id}_remaining_{instance_type}") for client in shards)
+            if force or (active == 0 and finished):
+                uploaded_runs.add(run_id)
+                upload_results(run_id, runs[run_id])
+
+
+def clear_outputs():
+    """Removes the uploaded results of every run, so that they are not uploaded again if the instance is adopted
+
+    Results of later adoptions are uploaded under the next `session`, next to those already uploaded."""
+    with runs_lock:
+        for run_id in run_dirs:
+            for directory in ["output", "attempts", "combined", "profiles"]:
+                shutil.rmtree(os.path.join(directory, run_id), ignore_errors=True)
+            os.makedirs(os.path.join("output", run_id), exist_ok=True)
+        profiles.clear()
+
+
+def main(slot):
+    """Main script call
+
+    Each attempt at a point writes to its own output file, which is moved next to the outputs of the slot if the point
+    succeeds and removed otherwise, so that failed and timed out attempts leave nothing in the results."""
+    kept = 0
+    while True:
+        controller.acquire_slot()
+        run, point, shard = claim_point()
+        if run is None:
+            controller.release_slot()
             break
-        except redis.WatchError:
+        if point is None:
+            controller.release_slot()
+            time.sleep(5)
             continue
 
+        run_id = run["run_id"]
+        run_dir = prepare_run(run)
+        fileout = os.path.abspath(os.path.join("attempts", run_id, f"{instance_id}_{slot}.h5"))
+        os.makedirs(os.path.dirname(fileout), exist_ok=True)
+        values, resources = split_point(unpack_point(point))
+
+        profile = None
+        if run.get("profile") and random.random() < run["profile"]:
+            profile = os.path.abspath(os.path.join("profiles", run_id, f"{slot}.txt"))
+            os.makedirs(os.path.dirname(profile), exist_ok=True)
 
-def main(fileout):
-    "Main script call"
-    remaining = json.loads(rcache.get(f"{worker_data['manager_instance_id']}_remaining"))
-    while remaining:
-        with rcache.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(f"{worker_data['manager_instance_id']}_remaining")
-                    pipe.watch(f"{worker_data['manager_instance_id']}_in_progress")
-
-                    remaining = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_remaining"))
-                    in_progress = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_in_progress"))
-
-                    try:
-                        point = remaining.pop()
-                        in_progress[instance_id]["points"].append(point)
-                        in_progress[instance_id]["check_in"] = str(arrow.utcnow())
-                    except IndexError:
-                        point = None
-                        break
-
-                    pipe.multi()
-                    pipe.set(f"{worker_data['manager_instance_id']}_in_progress", json.dumps(in_progress))
-                    pipe.set(f"{worker_data['manager_instance_id']}_remaining", json.dumps(remaining))
-                    pipe.execute()
-                    break
-                except redis.WatchError:
-                    continue
-
-        if point is not None:
-            logging.info(f"Starting point {point}")
-            subprocess.call(["/opt/anaconda/bin/python", "{script_path}", fileout] + [str(i) for i in point])
-            logging.info(f"Point {point} finished")
-
-            with rcache.pipeline() as pipe:
-                while True:
-                    try:
-                        pipe.watch(f"{worker_data['manager_instance_id']}_in_progress")
-                        pipe.watch(f"{worker_data['manager_instance_id']}_completed")
-                        completed = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_completed"))
-                        in_progress = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_in_progress"))
-                        in_progress[instance_id]["points"].remove(point)
-                        completed.append(point)
-                        pipe.multi()
-                        pipe.set(f"{worker_data['manager_instance_id']}_completed", json.dumps(completed))
-                        pipe.set(f"{worker_data['manager_instance_id']}_in_progress", json.dumps(in_progress))
-                        pipe.execute()
-                        break
-                    except redis.WatchError:
-                        continue
-        remaining = json.loads(rcache.get(f"{worker_data['manager_instance_id']}_remaining"))
+        controller.start(slot, resources)
+        logging.info(f"Starting point {values} of run {run_id}")
+        start = time.monotonic()
+        error = run_point(["/opt/anaconda/bin/python", os.path.join(run_dir, run['entry_point']), fileout] + [str(i) for i in values],
+                          pack_point(values) if resources else point, run_dir,
+                          timeout=resources.get("timeout", run.get("point_timeout")), memory=resources.get("memory", run.get("point_memory")),
+                          profile=profile, rate=run.get("profile_rate", 100))
+        controller.finish(slot)
+        if profile is not None:
+            record_profile(run_id, profile, time.monotonic() - start)
+
+        if error is None:
+            logging.info(f"Point {values} of run {run_id} finished")
+            if os.path.exists(fileout):
+                os.replace(fileout, os.path.join("output", run_id, f"{instance_id}_{slot}_{session}_{kept}.h5"))
+                kept += 1
+            complete_point(run_id, point, shard)
+        else:
+            if os.path.exists(fileout):
+                os.remove(fileout)
+            fail_point(run, point, values, error, shard)
+        upload_finished_runs()
 
 
 def is_alive():
     "Function to check if worker instance is still alive"
-    while True:
-        time.sleep(15)
+    while not finished.wait(15):
+        upload_finished_runs()
         cpu = max([sum(y) / len(y) for y in zip(*[psutil.cpu_percent(interval=1, percpu=True) for x in range(10)])])
-        if cpu > 25.0:
-            with rcache.pipeline() as pipe:
-                while True:
-                    try:
-                        pipe.watch(f"{worker_data['manager_instance_id']}_in_progress")
-                        in_progress = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_in_progress"))
-                        now = str(arrow.utcnow())
-                        try:
-                            in_progress[instance_id]["check_in"] = now
-                        except KeyError:
-                            break
-                        pipe.multi()
-                        pipe.set(f"{worker_data['manager_instance_id']}_in_progress", json.dumps(in_progress))
-                        pipe.execute()
-                        logging.debug(f"Updated {instance_id} 'check_in' to {now} ::: CPU @ {cpu}%")
-                        break
-                    except redis.WatchError:
-                        continue
-        else:
-            break
+        if cpu > 25.0 or preparing:
+            now = str(arrow.utcnow())
+            check_in = dict(time=now, instance_type=instance_type, cpu=cpu, memory=psutil.virtual_memory().percent, running=len(controller.running),
+                            limit=controller.limit)
+            rcache.hset(f"{manager_id}_check_in", instance_id, json.dumps(check_in))
+            logging.debug(f"Updated {instance_id} 'check_in' to {now} ::: CPU @ {cpu}%")
 
 
-thread = Thread(target=is_alive)
-thread.start()
+def park(ttl):
+    """Waits in the warm pool until a manager adopts this instance, for at most ttl seconds
 
-vcpus = cpu_count()
-if vcpus > 1:
-    vcpus //= worker_data['hyperthread_const']
+    Returns
+    -------
+    worker_data : dict or None
+        Worker data of the adopting manager, or None if no manager adopted this instance
+    """
+    entry = json.dumps(dict(instance_id=instance_id, until=time.time() + ttl))
+    pool_key = f"mcc_warm_{worker_data['template_id']}_{worker_data['template_version']}_{instance_type}"
+    rcache.rpush(pool_key, entry)
+    logging.info(f"Parked instance {instance_id} in warm pool for {ttl}s")
 
-pool = Pool(vcpus)
-pool.map(main, [f"output/{instance_id}_{i+1}.h5" for i in range(vcpus)])
+    job = rcache.blpop(f"mcc_warm_job_{instance_id}", timeout=ttl)
+    if job is None and not rcache.lrem(pool_key, 1, entry):
+        job = rcache.blpop(f"mcc_warm_job_{instance_id}", timeout=60)
 
-with rcache.pipeline() as pipe:
-    while True:
-        try:
-            pipe.watch(f"{worker_data['manager_instance_id']}_in_progress")
-            in_progress = json.loads(pipe.get(f"{worker_data['manager_instance_id']}_in_progress"))
-            del in_progress[instance_id]
-            pipe.multi()
-            pipe.set(f"{worker_data['manager_instance_id']}_in_progress", json.dumps(in_progress))
-            pipe.execute()
-            logging.info(f"Deleting instance {instance_id} from 'in_progress'")
-            break
-        except redis.WatchError:
-            continue
+    return json.loads(job[1]) if job is not None else None
+
+
+while True:
+    rcache.hset(f"{manager_id}_check_in", instance_id, json.dumps(dict(time=str(arrow.utcnow()), instance_type=instance_type)))
+    rcache.sadd(f"{manager_id}_workers", instance_id)
+
+    vcpus = cpu_count()
+    if vcpus > 1:
+        vcpus //= worker_data['hyperthread_const']
+
+    finished.clear()
+    controller = ConcurrencyController(vcpus, cpu_count())
+    controller_thread = Thread(target=controller.run, daemon=True)
+    controller_thread.start()
+
+    thread = Thread(target=is_alive)
+    thread.start()
+
+    try:
+        with Pool(cpu_count()) as pool:
+            pool.map(main, range(1, cpu_count() + 1))
+    finally:
+        finished.set()
+    thread.join()
+    controller_thread.join()
+
+    upload_finished_runs(force=True)
+
+    rcache.hdel(f"{manager_id}_check_in", instance_id)
+    logging.info(f"No points remaining for manager {manager_id}")
+
+    shutil.copyfile("worker.log", f"{instance_id}.log")
+    open("worker.log", "w").close()
+    upload_file(s3.meta.client, f"{instance_id}.log", worker_data['s3_bucket'], f"results/{manager_id}/{instance_id}.log", worker_data['compression'])
+    rcache.sadd(f"{manager_id}_finished", instance_id)
 
-logging.info(f"No points remaining, terminating instance {instance_id}")
+    adopted = park(worker_data['warm_ttl']) if worker_data.get('warm_ttl') else None
+    if adopted is None:
+        break
 
-shutil.copyfile("worker.log", f"output/{instance_id}.log")
+    clear_outputs()
+    session += 1
+    worker_data = adopted
+    manager_id = worker_data['manager_instance_id']
+    if worker_data['redis_topology'] != shards.topology:
+        shards = Shards(worker_data['redis_topology'])
+        rcache = shards.home
+        affinity = shards.affinity(instance_id)
+    rcache.srem(f"{manager_id}_finished", instance_id)
+    logging.info(f"Adopted by manager {manager_id}")
 
-for file in os.listdir("output"):
-    s3.meta.client.upload_file(file, worker_data['s3_bucket'], f"results/{worker_data['manager_instance_id']}/{file}")
+logging.info(f"Terminating instance {instance_id}")
 
 ec2 = boto3.resource("ec2")
-ec2.meta.client.describe_instances(InstanceIds=[instance_id])[0].terminate()
+ec2.Instance(instance_id).terminate()
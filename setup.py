@@ -39,7 +39,7 @@ def setup_package():
                     author_email="dfobes@lanl.gov",
                     license="BSD",
                     platforms=["macOS", "linux", "unix"],
-                    install_requires=["click", "awscli", "boto3"],
+                    install_requires=["arrow", "click", "awscli", "boto3", "redis>=4.2"],
                     setup_requires=["pytest-runner"],
                     tests_require=["pytest", "codecov"],
                     entry_points={"console_scripts": ["mcc=mcc.monitor.server:main"]},
@@ -0,0 +1,30 @@
+import ast
+import os
+import sys
+import types
+
+import pytest
+
+# mcc creates boto3 clients as default arguments when it is imported, which needs a region
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+MCC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mcc")
+
+
+@pytest.fixture
+def load_script(monkeypatch):
+    """Loads the imports, functions and classes of a userdata script without running it
+
+    The scripts start working as soon as they are executed, so everything else is skipped. The modules uploaded
+    next to them are importable as they are on instances."""
+    monkeypatch.setattr(sys, "path", sys.path + [MCC])
+
+    def load(name):
+        with open(os.path.join(MCC, name), "r") as f:
+            tree = ast.parse(f.read())
+        tree.body = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef))]
+        script = types.ModuleType(name)
+        exec(compile(tree, name, "exec"), script.__dict__)
+        return script
+
+    return load
@@ -0,0 +1,33 @@
+import io
+
+import pytest
+
+from mcc import codec
+
+
+def test_round_trip():
+    point = {"point": [0.1, 1e-17, 3], "resources": {"memory": 4096, "cpus": 2}}
+    assert codec.unpack_point(codec.pack_point(point)) == point
+    assert codec.split_point(codec.unpack_point(codec.pack_point(point))) == ([0.1, 1e-17, 3], {"memory": 4096, "cpus": 2})
+
+
+def test_numpy_round_trip():
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("msgpack")
+    values = np.arange(6, dtype="float32").reshape(2, 3)
+    decoded = codec.unpack_point(codec.pack_point(values))
+    assert decoded.dtype == values.dtype
+    assert (decoded == values).all()
+
+
+def test_json_fallback(monkeypatch):
+    monkeypatch.setattr(codec, "msgpack", None)
+    data = codec.pack_point([0.1, 0.2, 0.0])
+    assert data[:1] == codec.JSON
+    assert codec.unpack_point(data) == [0.1, 0.2, 0.0]
+    assert codec.read_point(io.BytesIO(data)) == [0.1, 0.2, 0.0]
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        codec.unpack_point(b"X[]")
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from mcc import analysis, index
+
+LOG = """2020-01-01 00:00:00,000:INFO:root:START
+2020-01-01 00:00:01,000:INFO:root:Run 0x1 started with 100 points
+2020-01-01 00:00:01,000:INFO:root:Run 0x1: Hyperthreading = True
+2020-01-01 00:00:02,000:INFO:root:Run 0x1: Manager launched {instances} 'c5.xlarge' Instances.
+2020-01-01 00:00:03,000:INFO:root:Run 0x2 started with streamed points
+2020-01-01 00:00:03,000:INFO:root:Run 0x2: Hyperthreading = False
+2020-01-01 00:00:04,000:INFO:root:Run 0x2: Manager launched 2 'r5.large' Instances.
+2020-01-01 00:00:05,000:INFO:root:Run 0x2: Manager adopted 1 'c5n.xlarge' Instances.
+2020-01-01 00:00:06,000:INFO:root:Run 0x3 started with 10 points
+2020-01-01 00:10:00,000:INFO:root:Run 0x1: completed: 10  in_progress: 2  stalled: 1  failed: 0
+2020-01-01 00:20:00,000:INFO:root:Run 0x3 failed: no worker instances could be launched for 900s
+2020-01-01 01:00:00,000:INFO:root:Run 0x1 finished
+2020-01-01 02:00:00,000:INFO:root:END
+"""
+
+
+def write_log(path, instances, mtime):
+    path.write_text(LOG.format(instances=instances))
+    os.utime(path, (mtime, mtime))
+
+
+def test_parse_log(tmp_path):
+    write_log(tmp_path / "i-1_manager.log", 4, 1000)
+    runs = analysis.parse_log(str(tmp_path / "i-1_manager.log"))
+    assert sorted(runs) == ["0x1", "0x2"]
+
+    assert runs["0x1"]["instances"] == 4
+    assert runs["0x1"]["instance_type"] == "c5.xlarge"
+    assert runs["0x1"]["hyper"] == 1
+    assert runs["0x1"]["stalls"] == 1
+    assert (runs["0x1"]["end"] - runs["0x1"]["start"]).total_seconds() == 3599
+
+    assert runs["0x2"]["instances"] == 3
+    assert runs["0x2"]["instance_types"] == {"r5.large": 2, "c5n.xlarge": 1}
+    assert runs["0x2"]["instance_type"] == "r5.large"
+    assert runs["0x2"]["hyper"] == 2
+    assert runs["0x2"]["stalls"] == 0
+    assert str(runs["0x2"]["end"]) == "2020-01-01T02:00:00+00:00"
+
+
+def test_incremental_parse(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    log = tmp_path / "results" / "i-1_manager.log"
+    write_log(log, 4, 1000)
+    run_index = index.open_index(str(tmp_path / "runs.sqlite"))
+
+    parsed = []
+    parse_log = analysis.parse_log
+    monkeypatch.setattr(analysis, "parse_log", lambda path: parsed.append(path) or parse_log(path))
+
+    data = analysis.collect_data(["i-1_manager.log"], index=run_index)
+    assert data["0x1"]["instances"] == 4
+    assert data["0x1"]["stalls"] == 1
+    assert data["0x2"]["instance_types"] == {"r5.large": 2, "c5n.xlarge": 1}
+    assert len(parsed) == 1
+
+    data = analysis.collect_data(["i-1_manager.log"], index=run_index)
+    assert data["0x1"]["instances"] == 4
+    assert data["0x2"]["instance_types"] == {"r5.large": 2, "c5n.xlarge": 1}
+    assert len(parsed) == 1
+
+    write_log(log, 6, 2000)
+    assert analysis.collect_data(["i-1_manager.log"], index=run_index)["0x1"]["instances"] == 6
+    assert len(parsed) == 2
+
+
+def test_update_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "results").mkdir()
+    write_log(tmp_path / "results" / "i-1_manager.log", 4, 1000)
+    (tmp_path / "results" / "0x1_data.h5").write_bytes(b"0" * 2048)
+    prices = {"c5.xlarge": (0.2, 4), "t2.micro": (0.01, 1)}
+    monkeypatch.setattr(analysis, "get_prices", lambda run_index, instance_type: prices[instance_type])
+
+    run_index = index.open_index(str(tmp_path / "runs.sqlite"))
+    data = analysis.update_index(run_index)
+    assert list(data) == ["0x1"]
+    assert data["0x1"]["data_size"] == 2
+    assert data["0x1"]["vcpus"] == 17
+    assert data["0x1"]["total_cost"] == pytest.approx(1.0 * (4 * 0.2 + 0.01) + 0.2)
+    assert list(index.query_runs(run_index, min_size=2)) == ["0x1"]
+
+
+def test_query_runs(tmp_path):
+    run_index = index.open_index(str(tmp_path / "runs.sqlite"))
+    for run_id, instance_type, start in [("0x1", "c5.xlarge", "2020-01-01"), ("0x2", "r5.large", "2020-02-01"),
+                                         ("0x3", "c5.xlarge", "2020-03-01")]:
+        info = dict(start=start, end=start, instances=1, instance_type=instance_type, instance_types={instance_type: 1},
+                    hyper=1, stalls=0)
+        index.store_log(run_index, f"i-{run_id}_manager.log", 1, 1.0, {run_id: info})
+        index.store_aggregate(run_index, run_id, 1, 1.0, dict(data_size=int(run_id, 16) * 1024, total_time=1.0, vcpus=5,
+                                                              total_cost=1.0, cost_per_vcpu=0.2, time_per_vcpu=0.2))
+
+    assert list(index.query_runs(run_index, instance_type="c5.xlarge")) == ["0x1", "0x3"]
+    assert list(index.query_runs(run_index, start="2020-01-15")) == ["0x2", "0x3"]
+    assert list(index.query_runs(run_index, instance_type=["c5.xlarge", "r5.large"], min_size=2048, max_size=2048)) == ["0x2"]
+    assert index.query_runs(run_index)["0x2"]["instance_type"] == "r5.large"
+    assert index.query_runs(run_index)["0x2"]["instance_types"] == {"r5.large": 1}
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from mcc import inputs
+
+
+class Client:
+    "Serves files from a directory as the objects of a bucket, counting downloads"
+    def __init__(self, root):
+        self.root = root
+        self.downloads = 0
+
+    def head_object(self, Bucket, Key):
+        return dict(ETag=f'"{os.path.getmtime(os.path.join(self.root, Key))}"')
+
+    def download_file(self, bucket, key, path):
+        self.downloads += 1
+        with open(os.path.join(self.root, key), "rb") as src, open(path, "wb") as dst:
+            dst.write(src.read())
+
+
+@pytest.fixture(autouse=True)
+def loaded(monkeypatch):
+    monkeypatch.setattr(inputs, "_loaded", {})
+
+
+def test_raw_input(tmp_path):
+    (tmp_path / "table.dat").write_bytes(b"read-only table")
+    client = Client(str(tmp_path))
+
+    manifest = inputs.prepare_inputs(client, "bucket", dict(table="table.dat"), cache_dir=str(tmp_path / "cache"))
+    assert inputs.prepare_inputs(client, "bucket", dict(table="table.dat"), cache_dir=str(tmp_path / "cache")) == manifest
+    assert client.downloads == 1
+
+    inputs.write_manifest(manifest, str(tmp_path / "inputs.json"))
+    view = inputs.load_input("table", str(tmp_path / "inputs.json"))
+    assert bytes(view) == b"read-only table"
+    assert view.readonly
+    assert inputs.load_input("table", str(tmp_path / "inputs.json")) is view
+
+
+def test_array_inputs(tmp_path):
+    np = pytest.importorskip("numpy")
+    np.save(tmp_path / "grid.npy", np.arange(10.0))
+    np.savez(tmp_path / "tables.npz", a=np.ones(3), b=np.zeros(2))
+    client = Client(str(tmp_path))
+
+    manifest = inputs.prepare_inputs(client, "bucket", dict(grid="grid.npy", tables="tables.npz"),
+                                     cache_dir=str(tmp_path / "cache"))
+    inputs.write_manifest(manifest, str(tmp_path / "inputs.json"))
+
+    grid = inputs.load_input("grid", str(tmp_path / "inputs.json"))
+    assert isinstance(grid, np.memmap)
+    assert not grid.flags.writeable
+    assert (grid == np.arange(10.0)).all()
+
+    tables = inputs.load_input("tables", str(tmp_path / "inputs.json"))
+    assert sorted(tables) == ["a", "b"]
+    assert (tables["a"] == 1).all()
@@ -0,0 +1,122 @@
+import asyncio
+import io
+import os
+import types
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from mcc.launch import RunHandle, launch_manager, template_path, upload_req_files
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class Client:
+    "Serves the objects put in it"
+    exceptions = type("exceptions", (), dict(NoSuchKey=NoSuchKey))
+
+    def __init__(self):
+        self.objects = {}
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys):
+        keys = sorted(key for key in self.objects if key.startswith(Prefix))[:MaxKeys]
+        return dict(Contents=[dict(Key=key) for key in keys]) if keys else {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise NoSuchKey(Key)
+        return dict(Body=io.BytesIO(self.objects[Key]))
+
+
+class Instance:
+    def __init__(self, state):
+        self.id = "i-manager"
+        self.state = dict(Name=state)
+
+    def reload(self):
+        pass
+
+
+@pytest.fixture
+def handle():
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        yield RunHandle("run", "bucket", Future(), executor, Client())
+
+
+def status(handle):
+    return asyncio.run(handle.status())
+
+
+def test_completed(handle):
+    assert status(handle) == "pending"
+    instance = Instance("pending")
+    handle.launch.set_result(dict(Instance=instance))
+    assert status(handle) == "pending"
+
+    instance.state["Name"] = "running"
+    assert status(handle) == "running"
+
+    handle.s3.objects["results/run_data.h5"] = b"results"
+    assert status(handle) == "completed"
+    assert handle.result_key == "results/run_data.h5"
+
+
+def test_failed_launch(handle):
+    handle.launch.set_exception(RuntimeError("InsufficientInstanceCapacity"))
+    assert status(handle) == "failed"
+    assert "InsufficientInstanceCapacity" in handle.error
+
+
+def test_failed_run(handle):
+    handle.launch.set_result(dict(Instance=Instance("running")))
+    handle.s3.objects["results/run.error"] = b"get_points raised"
+    assert status(handle) == "failed"
+    assert handle.error == "get_points raised"
+
+
+def test_stopped_without_result(handle):
+    handle.launch.set_result(dict(Instance=Instance("terminated")))
+    assert status(handle) == "failed"
+    assert "terminated without a result" in handle.error
+
+
+class Uploads:
+    "Records the keys uploaded to it and the file of each key"
+    def __init__(self):
+        self.keys = []
+        self.files = {}
+
+    def upload_file(self, path, bucket, key):
+        self.keys.append(key)
+        self.files[key] = path
+
+
+def test_upload_req_files():
+    s3 = types.SimpleNamespace(meta=types.SimpleNamespace(client=Uploads()))
+    upload_req_files("bucket", "0x1", s3=s3)
+    assert s3.meta.client.keys[:2] == ["script/0x1/combine_data.py", "script/0x1/points.py"]
+    assert "script/worker_userdata.py" in s3.meta.client.keys
+    assert "script/codec.py" in s3.meta.client.keys
+
+
+def test_upload_req_files_templates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "worker_userdata.py").write_text("stale copy")
+    s3 = types.SimpleNamespace(meta=types.SimpleNamespace(client=Uploads()))
+    upload_req_files("bucket", "0x1", s3=s3)
+    assert s3.meta.client.files["script/worker_userdata.py"] == template_path("worker_userdata.py")
+    assert os.path.isabs(template_path("worker_userdata.py"))
+
+    upload_req_files("bucket", "0x1", s3=s3, templates={"worker_userdata.py": "worker_userdata.py"})
+    assert s3.meta.client.files["script/worker_userdata.py"] == "worker_userdata.py"
+    assert s3.meta.client.files["script/manager_userdata.py"] == template_path("manager_userdata.py")
+
+    with pytest.raises(ValueError, match="Unknown"):
+        upload_req_files("bucket", "0x1", s3=s3, templates={"worker.py": "worker.py"})
+
+
+def test_launch_without_run_id():
+    with pytest.raises(ValueError, match="run_id"):
+        launch_manager(s3_bucket="bucket", entry_point="my_script.py", ec2=None)
@@ -0,0 +1,160 @@
+import gzip
+import io
+import sys
+import types
+from concurrent.futures import Future
+
+import botocore.exceptions
+import pytest
+
+
+@pytest.fixture
+def manager(load_script):
+    return load_script("manager_userdata.py")
+
+
+def test_merge_logs(manager, tmp_path):
+    first = tmp_path / "first.log"
+    first.write_text("2020-01-01 00:00:01,000:INFO:root:a\n"
+                     "2020-01-01 00:00:03,000:ERROR:root:c\nTraceback (most recent call last):\n  failed\n")
+    second = tmp_path / "second.log.gz"
+    second.write_bytes(gzip.compress(b"2020-01-01 00:00:02,000:INFO:root:b\n2020-01-01 00:00:04,000:INFO:root:d\n"))
+
+    out = io.BytesIO()
+    manager.merge_logs([str(first), str(second)], out)
+    assert out.getvalue().decode().splitlines() == ["2020-01-01 00:00:01,000:INFO:root:a",
+                                                    "2020-01-01 00:00:02,000:INFO:root:b",
+                                                    "2020-01-01 00:00:03,000:ERROR:root:c",
+                                                    "Traceback (most recent call last):",
+                                                    "  failed",
+                                                    "2020-01-01 00:00:04,000:INFO:root:d"]
+
+
+def test_merge_logs_in_groups(manager, tmp_path):
+    files = []
+    for worker in range(7):
+        files.append(tmp_path / f"{worker}.log")
+        files[-1].write_text("".join(f"2020-01-01 00:00:{second:02d},000:INFO:root:{worker}\n"
+                                     for second in range(worker, 60, 7)))
+
+    out = io.BytesIO()
+    manager.merge_logs([str(file) for file in files], out, max_open=2)
+    lines = out.getvalue().decode().splitlines()
+    assert lines == sorted(lines)
+    assert len(lines) == 60
+    assert sorted(tmp_path.iterdir()) == sorted(files)
+
+
+def test_route_point(manager):
+    run = dict(run_id="run", worker_pools=[dict(instance_type="c5.large", memory=3500, vcpus_per_node=2),
+                                           dict(instance_type="r5.xlarge", memory=30000, vcpus_per_node=4),
+                                           dict(instance_type="c5.4xlarge", memory=28000, vcpus_per_node=16)])
+    assert manager.route_point(run, {}) == "c5.large"
+    assert manager.route_point(run, dict(memory=8000)) == "r5.xlarge"
+    assert manager.route_point(run, dict(memory=8000, cpus=8)) == "c5.4xlarge"
+    assert manager.route_point(run, dict(memory=64000)) == "r5.xlarge"
+
+
+def test_launch_errors(manager):
+    class Client:
+        def run_instances(self, **launch):
+            raise botocore.exceptions.ClientError({"Error": {"Code": "InsufficientInstanceCapacity"}}, "RunInstances")
+
+    manager.ec2 = types.SimpleNamespace(meta=types.SimpleNamespace(client=Client()))
+    manager.registry = {}
+    manager.worker_userdata = lambda run, pool: ""
+    pool = dict(instance_type="c5.large", template_id="lt-1", template_version="1")
+    assert manager.launch_workers(dict(run_id="run"), pool, 4) == []
+    assert manager.registry == {}
+
+
+def test_pre_aggregate_failure(manager):
+    failed = []
+    manager.fail_run = lambda run, message: failed.append((run["run_id"], message))
+    partial = Future()
+    partial.set_exception(OSError("No space left on device"))
+
+    manager.pre_aggregate(dict(run_id="run", _combine=types.SimpleNamespace(supports_partial=True), _partial=partial))
+    assert failed == [("run", "OSError: No space left on device")]
+
+
+def test_combine_group(manager, tmp_path, monkeypatch):
+    files = [tmp_path / "0x1.h5.gz", tmp_path / "0x2.h5"]
+    files[0].write_bytes(gzip.compress(b"first\n"))
+    files[1].write_bytes(b"second\n")
+
+    def combine_data(paths, fileout):
+        assert sorted(tmp_path.iterdir()) == [tmp_path / "0x1.h5", tmp_path / "0x2.h5"]
+        with open(fileout, "wb") as out:
+            for path in paths:
+                out.write(open(path, "rb").read())
+
+    monkeypatch.setitem(sys.modules, "combine_data_run", types.SimpleNamespace(combine_data=combine_data))
+    fileout = tmp_path / "combined.h5"
+    manager.combine_group("combine_data_run", [str(file) for file in files], str(fileout))
+    assert fileout.read_bytes() == b"first\nsecond\n"
+    assert sorted(tmp_path.iterdir()) == [tmp_path / "0x2.h5", fileout]
+
+
+class Redis:
+    "Keeps lists and counters in memory, running pipelined commands as they are queued"
+    def __init__(self):
+        self.lists = {}
+        self.counters = {}
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+    def lrange(self, key, start, end):
+        return list(self.lists.get(key, []))
+
+    def rpoplpush(self, source, destination):
+        if not self.lists.get(source):
+            return None
+        value = self.lists[source].pop()
+        self.lists.setdefault(destination, []).insert(0, value)
+        return value
+
+    def decr(self, key, amount=1):
+        self.counters[key] = self.counters.get(key, 0) - amount
+        return self.counters[key]
+
+
+class Pipeline:
+    def __init__(self, client):
+        self.client = client
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: self.results.append(getattr(self.client, name)(*args))
+
+    def execute(self):
+        results, self.results = self.results, []
+        return results
+
+
+def test_resweep_workers(manager):
+    from codec import pack_point
+    from shards import Shards
+
+    clients = [Redis(), Redis()]
+    manager.shards = Shards.__new__(Shards)
+    manager.shards.clients = clients
+    manager.runs = {"run": dict(run_id="run", worker_pools=[dict(instance_type="c5.large", memory=3500, vcpus_per_node=2),
+                                                            dict(instance_type="r5.xlarge", memory=30000, vcpus_per_node=4)])}
+    clients[0].lists["run_in_progress_i-1"] = [pack_point([1])]
+    clients[1].lists["run_in_progress_i-1"] = [pack_point(dict(point=[2], resources=dict(memory=8000)))]
+
+    manager.resweep_workers(["i-1", "i-2"])
+    assert clients[0].lists == {"run_in_progress_i-1": [], "run_remaining_c5.large": [pack_point([1])]}
+    assert clients[1].lists["run_remaining_r5.xlarge"] == [pack_point(dict(point=[2], resources=dict(memory=8000)))]
+    assert [client.counters for client in clients] == [{"run_active": -1}, {"run_active": -1}]
+
+    manager.resweep_workers(["i-1"])
+    assert [client.counters for client in clients] == [{"run_active": -1}, {"run_active": -1}]
@@ -0,0 +1,35 @@
+import arrow
+import pytest
+
+from mcc.monitor.server import Monitor
+
+
+def snapshot(time, runs, stalled=()):
+    return dict(manager_id="i-manager", time=str(time), runs=runs, instances={"i-worker": dict(time=str(time))},
+                stalled=list(stalled))
+
+
+def test_update():
+    monitor = Monitor()
+    start = arrow.utcnow().shift(minutes=-2)
+    monitor.update(snapshot(start, {"run": dict(completed=0, total=90)}))
+    messages = monitor.update(snapshot(start.shift(minutes=1), {"run": dict(completed=30, total=90)},
+                                       [dict(instance_id="i-worker", points={"run": 2})]))
+    assert [message["type"] for message in messages] == ["status", "stall"]
+    assert list(monitor.events) == [messages[1]]
+
+    run = monitor.get_runs()["run"]
+    assert run["manager_id"] == "i-manager"
+    assert run["throughput"] == pytest.approx(30.0)
+    assert run["eta"] == pytest.approx(2.0)
+    assert run["instances"]["i-worker"]["age"] == pytest.approx(60, abs=5)
+
+    messages = monitor.update(snapshot(start.shift(minutes=2), {}))
+    assert [message["type"] for message in messages] == ["status", "finished"]
+    assert monitor.get_runs() == {}
+
+
+def test_stale_managers():
+    monitor = Monitor(stale=300)
+    monitor.update(snapshot(arrow.utcnow().shift(minutes=-10), {"run": dict(completed=0, total=100)}))
+    assert monitor.get_runs() == {}
@@ -0,0 +1,28 @@
+import collections
+
+from mcc import profiling
+
+
+def test_merge_profiles():
+    first = dict(stacks=collections.Counter({"main;run;solve": 3, "main;run": 1}), points=[[1.0, 4]],
+                 phases=dict(feed=dict(seconds=0.5, calls=2)))
+    second = dict(stacks=collections.Counter({"main;run;solve": 2}), points=[[2.0, 2]],
+                  phases=dict(feed=dict(seconds=1.0, calls=1), combine=dict(seconds=3.0, calls=1)))
+
+    merged = profiling.merge_profiles([first, second, {}])
+    assert merged["stacks"] == {"main;run;solve": 5, "main;run": 1}
+    assert merged["points"] == [[1.0, 4], [2.0, 2]]
+    assert merged["phases"] == dict(feed=dict(seconds=1.5, calls=3), combine=dict(seconds=3.0, calls=1))
+    assert profiling.self_time(merged["stacks"], n=1) == [("solve", 5, 5 / 6)]
+
+
+def test_profile_round_trip(tmp_path):
+    timer = profiling.PhaseTimer()
+    with timer.phase("combine"):
+        pass
+    profile = dict(stacks=collections.Counter({"main;run (entry.py:3)": 7}), points=[[1.5, 7]], phases=timer.as_dict())
+
+    path = str(tmp_path / "profile")
+    assert profiling.write_profile(profile, path) == [f"{path}.folded", f"{path}.json"]
+    assert (tmp_path / "profile.folded").read_text() == "main;run (entry.py:3) 7\n"
+    assert profiling.read_profile(path) == profile
@@ -0,0 +1,15 @@
+from mcc.shards import parse_topology
+
+
+def test_parse_topology():
+    assert parse_topology("redis.example.com") == [["redis.example.com", 6379]]
+    assert parse_topology("redis.example.com:6380") == [["redis.example.com", 6380]]
+    assert parse_topology({"Address": "redis.example.com", "Port": 6381}) == [["redis.example.com", 6381]]
+    assert parse_topology("redis.example.com", 6382) == [["redis.example.com", 6382]]
+    assert parse_topology(["redis.example.com", 6383]) == [["redis.example.com", 6383]]
+
+
+def test_parse_shards():
+    shards = ["home:6379", ["second", 6380], {"Address": "third", "Port": 6381}, "fourth"]
+    assert parse_topology(shards) == [["home", 6379], ["second", 6380], ["third", 6381], ["fourth", 6379]]
+    assert parse_topology(["home", "second"]) == [["home", 6379], ["second", 6379]]
@@ -0,0 +1,39 @@
+import pytest
+
+from mcc.templates import get_environment_fingerprint, run_steps
+
+
+def test_run_steps():
+    steps = {"security_group": ((), lambda: "sg"),
+             "image": (("security_group",), lambda security_group: f"{security_group}-ami"),
+             "redis": (("security_group",), lambda security_group: f"{security_group}-redis"),
+             "template": (("image", "redis"), lambda image, redis: f"{image}+{redis}")}
+    results, timings = run_steps(steps)
+    assert results["template"] == "sg-ami+sg-redis"
+    assert set(timings) == set(steps)
+
+
+def test_run_steps_cycle():
+    steps = {"a": (("b",), lambda b: b), "b": (("a",), lambda a: a), "c": ((), lambda: 1)}
+    with pytest.raises(ValueError, match="circular"):
+        run_steps(steps)
+
+
+def test_run_steps_unknown():
+    with pytest.raises(ValueError, match="unknown"):
+        run_steps({"a": (("missing",), lambda missing: missing)})
+
+
+def test_environment_fingerprint(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "template_script.sh").write_text("pip install {py_reqs}\naws configure set aws_access_key_id {aws_access_key}\n")
+    (tmp_path / "requirements.txt").write_text("numpy\nscipy\n")
+    fingerprint = get_environment_fingerprint(region="us-east-1", default_ami="ami-1")
+
+    (tmp_path / "requirements.txt").write_text("scipy\n\nnumpy\n")
+    assert get_environment_fingerprint(region="us-east-1", default_ami="ami-1") == fingerprint
+
+    assert get_environment_fingerprint(region="us-west-2", default_ami="ami-1") != fingerprint
+    assert get_environment_fingerprint(region="us-east-1", default_ami="ami-2") != fingerprint
+    (tmp_path / "requirements.txt").write_text("numpy\nscipy\npandas\n")
+    assert get_environment_fingerprint(region="us-east-1", default_ami="ami-1") != fingerprint
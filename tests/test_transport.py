@@ -0,0 +1,96 @@
+import gzip
+import io
+
+import pytest
+
+from mcc import transport
+
+
+class Client:
+    "Records the objects uploaded to it"
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+
+    def upload_fileobj(self, fileobj, bucket, key):
+        self.objects[key] = fileobj.read()
+
+    def upload_file(self, path, bucket, key):
+        with open(path, "rb") as f:
+            self.objects[key] = f.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.uploads[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        assert PartNumber == len(self.uploads[UploadId]) + 1
+        self.uploads[UploadId].append(Body)
+        return {"ETag": f"etag{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == list(range(1, len(self.uploads[UploadId]) + 1))
+        self.objects[Key] = b"".join(self.uploads[UploadId])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+
+def test_gzip_upload(tmp_path):
+    path = tmp_path / "data.h5"
+    path.write_bytes(b"results\n" * 100000)
+    client = Client()
+
+    key = transport.upload_file(client, str(path), "bucket", "results/run/data.h5", "gzip")
+    assert key == "results/run/data.h5.gz"
+    assert gzip.decompress(client.objects[key]) == path.read_bytes()
+
+    assert transport.upload_file(client, str(path), "bucket", "results/run/data.h5") == "results/run/data.h5"
+
+
+def test_open_file(tmp_path):
+    path = tmp_path / "worker.log.gz"
+    path.write_bytes(gzip.compress(b"first\nsecond\n"))
+
+    with transport.open_file(str(path), "r") as f:
+        assert f.read().splitlines() == ["first", "second"]
+
+    assert transport.strip_extension(str(path)) == str(tmp_path / "worker.log")
+    assert transport.open_file(str(path), "rb").read() == b"first\nsecond\n"
+
+
+def test_decompress_file(tmp_path):
+    path = tmp_path / "data.h5.gz"
+    path.write_bytes(gzip.compress(b"results"))
+
+    output = transport.decompress_file(str(path))
+    assert output == str(tmp_path / "data.h5")
+    assert open(output, "rb").read() == b"results"
+    assert transport.decompress_file(output) == output
+
+
+def test_compressing_reader():
+    reader = transport.CompressingReader(io.BytesIO(b"results" * 1000), transport.get_compressor("gzip"))
+    assert gzip.decompress(reader.read()) == b"results" * 1000
+
+
+def test_multipart_writer():
+    client = Client()
+    lines = b"".join(f"2020-01-01 00:00:00,000:INFO:root:point {i}\n".encode() for i in range(20000))
+    with transport.MultipartWriter(client, "bucket", "results/workers.log", "gzip", part_size=4096) as f:
+        for i in range(0, len(lines), 1000):
+            f.write(lines[i:i + 1000])
+
+    assert len(client.uploads["results/workers.log.gz"]) > 1
+    assert gzip.decompress(client.objects["results/workers.log.gz"]) == lines
+
+
+def test_multipart_writer_abort():
+    client = Client()
+    with pytest.raises(RuntimeError):
+        with transport.MultipartWriter(client, "bucket", "results/workers.log") as f:
+            f.write(b"partial")
+            raise RuntimeError("merge failed")
+
+    assert client.objects == {}
+    assert client.uploads == {}
@@ -0,0 +1,125 @@
+import threading
+import types
+
+import pytest
+
+
+@pytest.fixture
+def worker(load_script):
+    return load_script("worker_userdata.py")
+
+
+def wait_started(thread):
+    thread.start()
+    thread.join(0.2)
+    return not thread.is_alive()
+
+
+def test_slots(worker):
+    controller = worker.ConcurrencyController(2, 4)
+    controller.acquire_slot()
+    controller.acquire_slot()
+
+    third = threading.Thread(target=controller.acquire_slot)
+    assert not wait_started(third)
+    controller.release_slot()
+    third.join(1)
+    assert not third.is_alive()
+    assert controller.slots == 2
+
+
+def test_memory_hints(worker):
+    controller = worker.ConcurrencyController(4, 4)
+    large = dict(memory=2 * controller.available // 1024 ** 2)
+    for _ in range(2):
+        controller.acquire_slot()
+
+    # A point starts when nothing else is running, even if its hints do not fit
+    assert wait_started(threading.Thread(target=controller.start, args=("first", large)))
+
+    second = threading.Thread(target=controller.start, args=("second", large))
+    assert not wait_started(second)
+    controller.finish("first")
+    second.join(1)
+    assert not second.is_alive()
+    assert list(controller.running) == ["second"]
+
+
+def test_run_point_errors(worker, tmp_path, monkeypatch):
+    assert worker.run_point([str(tmp_path / "missing")], b"", str(tmp_path)).startswith("could not be started")
+
+    def prlimit(pid, limit, limits):
+        raise ProcessLookupError(3, "No such process")
+
+    monkeypatch.setattr(worker.resource, "prlimit", prlimit)
+    assert worker.run_point(["sleep", "60"], b"", str(tmp_path), memory=100).startswith("could not be limited to 100 MB")
+
+
+def test_attempt_outputs(worker, tmp_path, monkeypatch):
+    from codec import pack_point
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "output" / "run").mkdir(parents=True)
+    points = [pack_point([1]), pack_point([2]), pack_point([3])]
+    claims = iter([(dict(run_id="run", entry_point="entry.py"), point, 0) for point in points] + [(None, None, None)])
+    errors = iter(["timed out after 10s", None, None])
+    completed, failed = [], []
+
+    def run_point(args, point, cwd, **limits):
+        with open(args[2], "a") as f:
+            f.write(args[3])
+        return next(errors)
+
+    monkeypatch.setattr(worker, "instance_id", "i-1", raising=False)
+    monkeypatch.setattr(worker, "session", 0, raising=False)
+    monkeypatch.setattr(worker, "controller", worker.ConcurrencyController(1, 1), raising=False)
+    monkeypatch.setattr(worker, "claim_point", lambda: next(claims))
+    monkeypatch.setattr(worker, "prepare_run", lambda run: str(tmp_path))
+    monkeypatch.setattr(worker, "run_point", run_point)
+    monkeypatch.setattr(worker, "complete_point", lambda run_id, point, shard: completed.append(point))
+    monkeypatch.setattr(worker, "fail_point", lambda run, point, values, error, shard: failed.append(point))
+    monkeypatch.setattr(worker, "upload_finished_runs", lambda: None)
+
+    worker.main(1)
+    assert (completed, failed) == (points[1:], points[:1])
+    outputs = sorted((tmp_path / "output" / "run").iterdir())
+    assert [output.name for output in outputs] == ["i-1_1_0_0.h5", "i-1_1_0_1.h5"]
+    assert [output.read_text() for output in outputs] == ["2", "3"]
+    assert list((tmp_path / "attempts" / "run").iterdir()) == []
+
+
+def test_prepare_runs_concurrently(worker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for module in ["codec.py", "inputs.py"]:
+        (tmp_path / module).write_text("")
+    release = threading.Event()
+    downloads = []
+
+    def download_file(bucket, key, path):
+        downloads.append(key)
+        if bucket == "slow":
+            release.wait(5)
+        open(path, "w").close()
+
+    objects = lambda bucket: types.SimpleNamespace(filter=lambda Prefix: [types.SimpleNamespace(key=f"{Prefix}entry.py")])
+    monkeypatch.setattr(worker, "s3", types.SimpleNamespace(Bucket=lambda bucket: types.SimpleNamespace(objects=objects(bucket)),
+                                                            meta=types.SimpleNamespace(client=types.SimpleNamespace(download_file=download_file))),
+                        raising=False)
+
+    for name, value in [("runs_lock", threading.Lock()), ("run_dirs", {}), ("preparing", set()), ("preparation_locks", {})]:
+        monkeypatch.setattr(worker, name, value, raising=False)
+
+    slow = [threading.Thread(target=worker.prepare_run, args=(dict(run_id="0x1", s3_bucket="slow"),)) for _ in range(2)]
+    for thread in slow:
+        thread.start()
+    while not downloads:
+        release.wait(0.01)
+    assert worker.prepare_run(dict(run_id="0x2", s3_bucket="fast")) == str(tmp_path / "runs" / "0x2")
+    assert worker.preparing == {"0x1"}
+
+    release.set()
+    for thread in slow:
+        thread.join(5)
+    assert downloads == ["script/0x1/entry.py", "script/0x2/entry.py"]
+    assert worker.preparing == set()
+    assert sorted(worker.run_dirs) == ["0x1", "0x2"]